@@ -0,0 +1,70 @@
+import threading
+
+
+class RoomActors:
+    """
+    One command queue and one consumer task per live room.
+
+    Socket handlers only enqueue work for their room, so every room applies
+    its commands strictly in arrival order on a single task and handlers of
+    the same room never wait on each other's lock. The consumer drains
+    whatever queued up while it was busy, applies that batch and only then
+    sends the batch's broadcasts. A consumer that stays idle for
+    idle_timeout seconds exits and is started again by the next command.
+    """
+
+    def __init__(self, server, batch_size=32, idle_timeout=30):
+        # server provides create_queue, get_queue_empty_exception and start_background_task,
+        # e.g. socketio.server.eio, so the queues match the async mode in use
+        self.server = server
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.queues = {}  # room_id -> queue of (work, reply)
+        self._lock = threading.Lock()
+
+    def submit(self, room_id, work, reply=None):
+        """
+        Queues work() to run on the room's consumer, reply(result) is called
+        with its return value once its batch has been applied.
+        """
+        with self._lock:
+            queue = self.queues.get(room_id)
+            if queue is None:
+                queue = self.queues[room_id] = self.server.create_queue()
+                self.server.start_background_task(self._consume, room_id, queue)
+            queue.put((work, reply))
+
+    def _consume(self, room_id, queue):
+        empty = self.server.get_queue_empty_exception()
+        while True:
+            try:
+                batch = [queue.get(timeout=self.idle_timeout)]
+            except empty:
+                with self._lock:
+                    # submit holds the lock while it puts, so an empty queue here stays empty
+                    if queue.empty():
+                        del self.queues[room_id]
+                        return
+                continue
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                except empty:
+                    break
+
+            replies = []
+            for work, reply in batch:
+                try:
+                    result = work()
+                except Exception as e:
+                    print(f"Command for room {room_id} failed: {e}")
+                    continue
+                if reply is not None:
+                    replies.append((reply, result))
+
+            for reply, result in replies:
+                try:
+                    reply(result)
+                except Exception as e:
+                    print(f"Broadcast for room {room_id} failed: {e}")
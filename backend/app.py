@@ -1,145 +1,310 @@
+import concurrency  # first, it may monkey patch the standard library
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from bson.objectid import ObjectId
-from models import rooms_collection
 
 from flask_socketio import SocketIO, emit
 
 import string
 import random
 import json
+import atexit
+import os
+import signal
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
 
 from game_logic import *
-from datetime import datetime
+from serialization import serialize_game, serialize_views, strip_private, deserialize_game
+from registry import GameRegistry
+from actors import RoomActors
+from broadcast import MarketBatcher
+from codec import CODECS, negotiate
+from sharding import Shards, client_manager
+from store import new_store, valid_room_id, DuplicateRoom
+from persistence import WriteBehind
+from journal import Journal
+import lobby
+from contextlib import ExitStack
+import settlement
 
 app = Flask(__name__)
 CORS(app, origins=["*"])
+
+# Rooms are spread over the workers listed in WORKERS, each room is only ever live on its owner
+shards = Shards.from_env()
+
 socketio = SocketIO(
     app,
     cors_allowed_origins="*",
     ping_timeout=60,
     ping_interval=25,
-    transports=['websocket']
+    transports=['websocket'],
+    async_mode=concurrency.mode,
+    # Emits reach clients connected to any worker through SOCKETIO_MESSAGE_QUEUE
+    client_manager=client_manager(os.environ.get('SOCKETIO_MESSAGE_QUEUE'), shards.worker_id)
 )
 
 def generate_room_code(length=6):
     return ''.join(random.choices(string.ascii_uppercase, k=length))
 
-def serialize_game(game):
-    return {
-        "players": [
-            {
-                "username": player.get_name(),
-                "status": player.get_status(),
-                "last_active": player.get_last_active(),
-                "high_low": player.high_low,
-                "contract": {
-                    "type_of_action": player.contract.type_of_action if player.contract else None,
-                    "number": player.contract.number if player.contract else None,
-                },
-                "buy_count": player.buy_count,
-                "sell_count": player.sell_count,
-                "record": player.record,
-                "cumulative_pnl": player.cumulative_pnl,
-                "round_pnl": player.round_pnl,  
-            }
-            for player in game.players
-        ],
-        "host": game.get_host(),
-        "player_count": game.player_count,
-        "current_round": game.current_round,
-        "timer": game.timer,
-        "dices": [dice.get_value() for dice in game.dices] if game.dices else None,
-        "coin": game.coin.get_value() if game.coin else None,
-        "current_bid": game.current_bid,
-        "current_ask": game.current_ask,
-        "bid_player": game.bid_player.get_name() if game.bid_player else None,
-        "ask_player": game.ask_player.get_name() if game.ask_player else None,
-        "hit_player": game.hit_player.get_name() if game.hit_player else None,
-        "lift_player": game.lift_player.get_name() if game.lift_player else None,
-        "market_active": game.market_active,
-        "round_active": game.round_active,
-        "fair_value": game.fair_value,
-    }
+def restore_game(room_id, room):
+    # The journal is written on every event, so it can be ahead of a write-behind that never flushed,
+    # unless it builds on an older version than the stored one
+    version = room.get("version", 0)
+    game = journal.recover(room_id, version)
+    if game is not None:
+        game.persisted = False
+        persistence.mark_dirty(room_id)
+        game.version = version
+        return game
+    game = deserialize_game(room.get("game", {}))
+    game.version = version
+    # What gets journaled from here on builds on the stored state
+    journal.snapshot(room_id, game)
+    return game
 
+def load_game(room_id):
+    room = store.get(room_id, {"game": 1, "version": 1})
+    if not room:
+        return None
+    return restore_game(room_id, room)
+
+def load_games(room_ids):
+    rooms = store.get_many(room_ids, {"game": 1, "version": 1})
+    return {str(room["_id"]): restore_game(str(room["_id"]), room) for room in rooms}
+
+# Room documents, MongoDB unless ROOM_STORE=memory
+store = new_store()
+
+# Live games keyed by room id, MongoDB is only used for durability while a room is active
+games = GameRegistry(load_game, load_games)
+
+def rebase(room_id, commands):
+    """
+    Called when a write-behind flush finds the stored room at a newer version
+    than the one our game builds on, i.e. another process wrote it. Reloads the
+    stored state and re-applies the commands that weren't written on top of
+    it, like a retried transaction, then resyncs the room's clients.
+    """
+    with games.lock(room_id):
+        commands = commands + games.take_commands(room_id)
+        room = store.get(room_id, {"game": 1, "version": 1})
+        if room is None:
+            games.discard(room_id)
+            persistence.discard(room_id)
+            return
 
-def deserialize_game(game_data):
-    game = Game()
+        game = deserialize_game(room.get("game", {}))
+        game.version = room.get("version", 0)
+        for command in commands:
+            command(game)
+            games.record_command(room_id, command)
+        games.put(room_id, game)
+        persistence.mark_dirty(room_id)
+        journal.snapshot(room_id, game)
+        game_data = serialize_game(game)
+        public, private = serialize_views(game)
+
+    print(f"Rebased room {room_id} onto version {game.version} with {len(commands)} commands")
+    emit_game('room_resync', room_id, game_data)
+    market_feed.send(room_id, 'round_update', {"event": "resync", "game": public}, private=private)
+
+# Append-only event log used for crash recovery, written in the background
+journal = Journal(os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal"), offload=concurrency.offload)
+socketio.start_background_task(journal.run, socketio.sleep)
+atexit.register(journal.close)  # runs after persistence.close, which may still snapshot
+
+# Dirty rooms are written back in coalesced batches instead of inside every handler
+persistence = WriteBehind(store, games, on_conflict=rebase)
+socketio.start_background_task(persistence.run, socketio.sleep)
+atexit.register(persistence.close)
+
+def mutate(room_id, command, retries=5):
+    """
+    Applies one command to a live room. command(game) runs under the room lock
+    and returns (result, event), where event is (journal event type, data) if
+    the game changed and None otherwise. Changed rooms are marked dirty, the
+    event is journaled and the command is kept until its write lands, so it
+    can be re-applied if that write hits a version conflict. Returns result,
+    or None if the room doesn't exist.
+    """
+    for _ in range(retries):
+        game = games.get(room_id)
+        if game is None:
+            return None
+        with games.lock(room_id):
+            if games.games.get(room_id) is not game:
+                continue  # rebased or ended while we waited for the lock
+            result, event = command(game)
+            if event is not None:
+                event_type, data = event
+                games.record_command(room_id, command)
+                persistence.mark_dirty(room_id)
+                journal.record(room_id, game, event_type, **data)
+            return result
+    raise RuntimeError(f"Room {room_id} kept changing, giving up")
+
+# Socket commands run on one consumer per room, in arrival order
+actors = RoomActors(socketio.server.eio)
+
+def submit(room_id, command, reply):
+    """
+    Queues a mutate(room_id, command) on the room's actor, reply(result)
+    sends its broadcasts once the batch it ran in is applied. For a room that
+    doesn't exist reply(None) is called right away, as mutate would.
+    """
+    if not room_exists(room_id):
+        reply(None)
+        return
+    actors.submit(room_id, lambda: mutate(room_id, command), reply)
+
+def room_exists(room_id):
+    # Checked before a room gets an actor, so made-up ids don't each start a queue and a consumer
+    return valid_room_id(room_id) and games.get(room_id) is not None
+
+# Lobby listing served from memory, with diffs pushed to sockets in the "lobby" room
+# by the one worker that owns the lobby, so subscribers see a single version sequence
+LOBBY = 'lobby'
+lobby_cache = lobby.LobbyCache(store)
+if shards.is_local(LOBBY):
+    socketio.start_background_task(lobby_cache.run, lambda diff: socketio.emit('lobby_update', diff, room=LOBBY), sleep=socketio.sleep)
+
+# Market data goes to each room's sockets by the protocol they joined with: 1 (default)
+# gets a market_update per quote or trade and whole games on round events, 2 a sequenced
+# feed of market_batch deltas every MARKET_BATCH_MS and round_update views. Games are
+# sent in the codec each socket negotiated, JSON unless it asked for msgpack
+def market_room(room_id, protocol, codec="json"):
+    return f"{room_id}:market:{protocol}:{codec}"
+
+def market_rooms(room_id, protocol):
+    return [market_room(room_id, protocol, name) for name in CODECS]
+
+# room_id -> codecs other than JSON that a socket of the room negotiated, see handle_use_codec
+room_codecs = {}
+
+def codecs_for(room_id):
+    # JSON always, other codecs only once a socket of the room asked for them
+    return [(name, CODECS[name]) for name in ["json", *sorted(room_codecs.get(room_id, ()))]]
+
+def emit_game(event, room_id, game_data, protocols=(1,)):
+    # Encoded once per codec in use; JSON sockets keep getting the JSON string protocol 1 always sent.
+    # Nobody gets another player's private fields, their own come as a player_view
+    game_data = strip_private(game_data)
+    for name, codec in codecs_for(room_id):
+        payload = json.dumps(game_data) if name == "json" else codec.encode(game_data)
+        socketio.emit(event, {"roomId": room_id, "gameData": payload},
+                      to=[market_room(room_id, protocol, name) for protocol in protocols])
+
+def emit_feed(room_id, event, message):
+    if "game" not in message:
+        socketio.emit(event, message, to=market_rooms(room_id, 2))
+        return
+    for name, codec in codecs_for(room_id):
+        socketio.emit(event, dict(message, game=codec.encode(message["game"])), to=market_room(room_id, 2, name))
 
-    # Restore players
-    for player_data in game_data.get("players", []):
-        player = Player(
-            name=player_data.get("username", "Unknown"),
-            status=player_data.get("status", "active"),
-            last_active=(
-                datetime.fromisoformat(player_data["last_active"])
-                if player_data.get("last_active")
-                else None
-            ),
-        )
-        player.high_low = player_data.get("high_low")
-        player.buy_count = player_data.get("buy_count", 0)
-        player.sell_count = player_data.get("sell_count", 0)
-        player.record = player_data.get("record", [])
-        player.cumulative_pnl = player_data.get("cumulative_pnl", 0)
-        player.round_pnl = player_data.get("round_pnl", 0)
-
-        # Restore contract
-        contract_data = player_data.get("contract")
-        if contract_data and contract_data["type_of_action"]:
-            player.contract = Action(
-                type_of_action=contract_data["type_of_action"],
-                number=contract_data["number"],
-            )
-
-        game.player_join(player)
-
-    # Restore game state
-    game.set_host(game_data.get("host", None))
-    game.player_count = game_data.get("player_count", 0)
-    game.current_round = game_data.get("current_round", 0)
-    game.timer = game_data.get("timer", 0)
-    game.dices = (
-        [Dice() for _ in range(len(game_data["dices"]))] if game_data.get("dices") else None
-    )
-    if game.dices and game_data.get("dices"):
-        for dice, value in zip(game.dices, game_data["dices"]):
-            dice.value = value
-
-    game.coin = Coin()
-    if game_data.get("coin"):
-        game.coin.value = game_data["coin"]
-
-    game.current_bid = game_data.get("current_bid", 0)
-    game.current_ask = game_data.get("current_ask", 21)
-    game.market_active = game_data.get("market_active", True)
-    game.round_active = game_data.get("round_active", False)
-    game.fair_value = game_data.get("fair_value", 0)
-
-    # Restore player references
-    bid_player_name = game_data.get("bid_player")
-    ask_player_name = game_data.get("ask_player")
-    hit_player_name = game_data.get("hit_player")
-    lift_player_name = game_data.get("lift_player")
-
-    if bid_player_name:
-        game.bid_player = next(
-            (player for player in game.players if player.name == bid_player_name), None
-        )
-    if ask_player_name:
-        game.ask_player = next(
-            (player for player in game.players if player.name == ask_player_name), None
-        )
-    if hit_player_name:
-        game.hit_player = next(
-            (player for player in game.players if player.name == hit_player_name), None
-        )
-    if lift_player_name:
-        game.lift_player = next(
-            (player for player in game.players if player.name == lift_player_name), None
-        )
+market_feed = MarketBatcher(emit_feed, lambda sid, event, message: socketio.emit(event, message, to=sid),
+                            interval=int(os.environ.get('MARKET_BATCH_MS', 25)) / 1000)
+socketio.start_background_task(market_feed.run, socketio.sleep)
 
-    return game
+def top_of_book(game):
+    return {
+        "currentBid": game.current_bid,
+        "currentAsk": game.current_ask,
+        "bidPlayer": game.bid_player.name if game.bid_player else None,
+        "askPlayer": game.ask_player.name if game.ask_player else None,
+        "depth": game.market_depth(),
+    }
+
+def player_counters(game, *names):
+    counters = {}
+    for name in names:
+        player = game.find_player(name)
+        if player is not None:
+            counters[name] = {"buy_count": player.buy_count, "sell_count": player.sell_count}
+    return counters
+
+def broadcast_market(room_id, result):
+    socketio.emit("market_update", result["update"], to=market_rooms(room_id, 1))
+    market_feed.publish(room_id, result["top"], result["update"]["logMessage"],
+                        trade=result.get("trade"), players=result.get("players"))
+
+def broadcast_round(room_id, event, game_data, views):
+    # Protocol 1 gets the whole game but the private fields, protocol 2 the public view; each
+    # registered player gets their own overlay
+    emit_game(event, room_id, game_data)
+    public, private = views
+    market_feed.send(room_id, 'round_update', {"event": event, "game": public}, private=private)
+
+# Socket handlers for events addressed to a room, by event name
+room_handlers = {}
+
+def room_event(name, key=lambda data: data.get('roomId')):
+    """
+    Registers handler(data, sid) for a socket event. It runs on the worker
+    that owns key(data) (the room by default); other workers forward the
+    event there through the message queue.
+    """
+    def decorator(handler):
+        room_handlers[name] = handler
+
+        def on_event(data=None):
+            data = data or {}
+            dispatch_event(name, key(data), data, request.sid)
+
+        socketio.on_event(name, on_event)
+        return handler
+    return decorator
+
+def dispatch_event(name, room_id, data, sid):
+    if room_id is None or shards.is_local(room_id):
+        room_handlers[name](data, sid)
+    else:
+        forward_event(shards.owner(room_id), name, data, sid)
+
+def forward_event(worker, name, data, sid):
+    manager = socketio.server.manager
+    if not hasattr(manager, 'send_command'):
+        print(f"No message queue to forward {name} to worker {worker}, handling it here")
+        room_handlers[name](data, sid)
+        return
+    manager.send_command(worker, name, data, sid)
+
+def run_forwarded(message):
+    # Another worker received a socket event for one of our rooms
+    handler = room_handlers.get(message["event"])
+    if handler is not None:
+        handler(message["data"], message["sid"])
+
+if hasattr(socketio.server.manager, 'send_command'):
+    socketio.server.manager.on_command = run_forwarded
+    # The server only starts listening on its first connection, but other workers
+    # may forward commands before anyone connects here
+    socketio.server.manager_initialized = True
+    socketio.server.manager.initialize()
+
+def forward_request(room_id, path=None, payload=None):
+    """
+    Replays the current HTTP request (or a POST of payload to path) on the
+    worker that owns room_id and returns its response, or None when the room
+    is ours or the owner's URL is unknown.
+    """
+    owner = shards.owner(room_id)
+    if owner == shards.worker_id or owner not in shards.urls:
+        return None
+    if payload is not None:
+        body, method = json.dumps(payload).encode(), 'POST'
+    else:
+        body, method, path = request.get_data(), request.method, request.full_path
+    forwarded = urllib.request.Request(shards.urls[owner] + path, data=body, method=method,
+                                       headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(forwarded, timeout=10) as response:
+            return app.response_class(response.read(), status=response.status, mimetype='application/json')
+    except urllib.error.HTTPError as e:
+        return app.response_class(e.read(), status=e.code, mimetype='application/json')
 
 @app.route('/create-room', methods=['POST'])
 def create_room():
@@ -150,16 +315,9 @@ def create_room():
 
     username = data.get("username")
 
-    if rooms_collection.find_one({"name": name}):
-        return jsonify({"message": "Room with this name already exists"}), 400
-
     if len(username) < 3:
         return jsonify({"message": "Username must be at least 3 characters long"}), 400
     
-    room_code = generate_room_code()
-    while rooms_collection.find_one({"room_code": room_code}):
-        room_code = generate_room_code()
-    
     game = Game()
 
     #initiate first player
@@ -175,14 +333,32 @@ def create_room():
         "game": serialize_game(game),
         "maxPlayers": 10,
         "isPrivate": is_private,
-        "room_code": room_code
+        "room_code": None,
+        "version": 0
     }
+    room.update(lobby.room_summary(game, room["maxPlayers"]))
 
     try:
-        result = rooms_collection.insert_one(room)
+        # The unique indexes on name and room_code decide, a taken code just means another draw
+        for _ in range(10):
+            room_code = room["room_code"] = generate_room_code()
+            try:
+                room_id = store.put(room)
+                break
+            except DuplicateRoom as e:
+                if e.field == "name":
+                    return jsonify({"message": "Room with this name already exists"}), 400
+        else:
+            return jsonify({"message": "Could not allocate a room code"}), 500
+
+        game.mark_clean()
+        if shards.is_local(room_id):
+            games.put(room_id, game)
+            journal.record(room_id, game, "create", player=username)
+        lobby_cache.invalidate()
         return jsonify({
             "message": "Room created successfully",
-            "roomId": str(result.inserted_id),
+            "roomId": room_id,
             "roomCode": room_code,
             "num_players": 1,
             "player_list": [username],
@@ -194,40 +370,45 @@ def create_room():
     
 @app.route('/rooms', methods=['GET'])
 def get_rooms():
+    """
+    Lobby listing served from the lobby cache. Optional query parameters:
+    limit and cursor for pagination (the next cursor comes back in the
+    X-Next-Cursor header), public=1 and has_space=1 to filter. Answers 304
+    when If-None-Match still matches the listing's ETag.
+    """
     try:
-        rooms = list(rooms_collection.find(
-            {},
-            {
-                "_id": 1,
-                "name": 1,
-                "game.players": 1,
-                "game.player_count": 1,
-                "maxPlayers": 1,
-                "isPrivate": 1,
-                "room_code": 1
-            }
-        ))
-
-        formatted_rooms = []
-        for room in rooms:
-            
-            game = deserialize_game(room.get("game", {}))
-
-            formatted_room = {
-                "_id": str(room["_id"]),
-                "name": room["name"],
-                "players": [player.to_dict() for player in game.players],  # Serialize players to dict
-                "player_count": game.player_count,
-                "maxPlayers": room.get('maxPlayers', 10),
-                "isPrivate": room.get('isPrivate', False),
-                "room_code": room.get('room_code')
-            }
-            formatted_rooms.append(formatted_room)
-            
-        return jsonify(formatted_rooms), 200
+        limit = request.args.get('limit', type=int)
+        cursor = request.args.get('cursor')
+        public_only = request.args.get('public') in ('1', 'true')
+        has_space = request.args.get('has_space') in ('1', 'true')
+
+        rooms, version = lobby_cache.get()
+        etag = lobby_cache.etag(version, request.query_string.decode())
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+        rooms, next_cursor = lobby.filter_rooms(
+            rooms,
+            limit=min(limit, 200) if limit else None,
+            cursor=cursor,
+            public_only=public_only,
+            has_space=has_space,
+        )
+
+        response = jsonify(rooms)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
     except Exception as e:
         return jsonify({"message": str(e)}), 500
     
+# Room settings read by join_room
+JOIN_FIELDS = {"isPrivate": 1, "password": 1, "maxPlayers": 1}
+
 @app.route('/join-room', methods=['POST'])
 def join_room():
     data = request.json
@@ -237,10 +418,11 @@ def join_room():
     room_code = data.get('roomCode')
 
     try:
+        # The game itself comes from the registry, only the room settings checked here are fetched
         if room_id:
-            room = rooms_collection.find_one({"_id": ObjectId(room_id)})
+            room = store.get(room_id, JOIN_FIELDS)
         elif room_code:
-            room = rooms_collection.find_one({"room_code": room_code})
+            room = store.find_by_code(room_code, JOIN_FIELDS)
         else:
             return jsonify({"message": "Room ID or Room Code is required"}), 400
 
@@ -253,39 +435,47 @@ def join_room():
         if len(username) < 3:
             return jsonify({"message": "Username must be at least 3 characters long"}), 400
         
-        room["game"] = deserialize_game(room.get("game", {}))
-        num_players = len(room["game"].players)
-
-        # Check if room is full
-        if num_players >= room.get('maxPlayers', 10):
-            print('room_full')
-            return jsonify({"message": "Room is full"}), 400
-
-        # Check if username is already taken in this room
-        username_list = []
-        name_taken = False
-        for player in room["game"].players:
-            if username == player.get_name():
-                name_taken = True
-                break
-            username_list.append(player.get_name())
-            
-        if name_taken:
-            return jsonify({"message": "Username taken"}), 400
-        
-        username_list.append(username)
-    
-        #initiate new player
-        new_player = Player(username)
-        new_player.status = "active"
-        room["game"].player_join(new_player)
-
-        host_username = room["game"].get_host()
+        room_key = str(room["_id"])
+        forwarded = forward_request(room_key)
+        if forwarded is not None:
+            return forwarded
+
+        def join(game):
+            # Check if room is full
+            if len(game.players) >= room.get('maxPlayers', 10):
+                print('room_full')
+                return {"error": "Room is full"}, None
+
+            # Check if username is already taken in this room (names are matched case-insensitively in game)
+            if game.find_player(username):
+                return {"error": "Username taken"}, None
+
+            username_list = [player.get_name() for player in game.players]
+            username_list.append(username)
+
+            #initiate new player
+            new_player = Player(username)
+            new_player.status = "active"
+            game.player_join(new_player)
+
+            return {
+                "num_players": len(username_list) - 1,
+                "username_list": username_list,
+                "host_username": game.get_host(),
+                "summary": lobby.room_summary(game, room.get('maxPlayers', 10)),
+            }, ("join", {"player": username})
+
+        joined = mutate(room_key, join)
+        if joined is None:
+            return jsonify({"message": "Room not found"}), 404
+        if "error" in joined:
+            return jsonify({"message": joined["error"]}), 400
+        num_players = joined["num_players"]
+        username_list = joined["username_list"]
+        host_username = joined["host_username"]
 
-        rooms_collection.update_one(
-            {"_id": room["_id"]}, 
-            {"$set": {"game": serialize_game(room["game"])}}
-        )
+        store.patch(room_key, {"$set": joined["summary"]})
+        lobby_cache.invalidate()
 
         # Notify all clients in the room about the new player
         print(f"Emitting 'player_joined' event to room {room['_id']} with username {username}")
@@ -319,54 +509,76 @@ def player_disconnect():
         return jsonify({"message": "Room ID and Username are required"}), 400
     
     try:
-        room = rooms_collection.find_one({"_id": ObjectId(room_id)})
+        forwarded = forward_request(room_id)
+        if forwarded is not None:
+            return forwarded
+
+        # Only the room settings, for the lobby summary
+        room = store.get(room_id, JOIN_FIELDS)
         if not room:
             return jsonify({"message": "Room not found"}), 404
-        
-        game = deserialize_game(room.get("game", {}))
 
-        # Remove the player who left
-        game.players = [player for player in game.players if player.name != username]
-        game.player_count = len(game.players)
+        def leave(game):
+            # Remove the player who left
+            leaving_player = game.find_player(username)
+            if leaving_player and leaving_player.name == username:
+                game.player_leave(leaving_player)
+            game.player_count = len(game.players)
 
-        # Check if the leaving player is the host
-        if username == game.get_host():
-            # Transfer host to the first player who joined after the host (or any active player)
+            # Check if the leaving player is the host
             new_host = None
-            if game.players:
+            if username == game.get_host() and game.players:
+                # Transfer host to the first player who joined after the host (or any active player)
                 new_host = game.players[0].name  # Assign host to the first player in the list
                 game.set_host(new_host)
 
-                # Notify all players about the new host
-                socketio.emit('update_host', {
-                    "roomId": str(room["_id"]),
-                    "newHost": new_host
-                }, room=str(room["_id"]))
-
-                # Log the new host in the game log
-                socketio.emit('player_left', {
-                    "roomId": str(room["_id"]),
-                    "username": username,
-                    "num_players": game.player_count,
-                    "newHost": new_host  
-                }, room=str(room["_id"]))
-            else:
-                # If no players are left, delete the room
-                rooms_collection.delete_one({"_id": ObjectId(room_id)})
-                return jsonify({"message": "Room deleted because no players are left"}), 200
-
-        # Update the room with the new game state
-        rooms_collection.update_one(
-            {"_id": ObjectId(room_id)},
-            {"$set": {"game": serialize_game(game)}}
-        )
+            return {
+                "new_host": new_host,
+                "empty": not game.players,
+                "num_players": game.player_count,
+                "summary": lobby.room_summary(game, room.get('maxPlayers', 10)),
+            }, ("leave", {"player": username, "host": game.get_host()})
+
+        left = mutate(room_id, leave)
+        if left is None:
+            return jsonify({"message": "Room not found"}), 404
+
+        if left["empty"]:
+            # If no players are left, delete the room
+            store.delete(room_id)
+            persistence.discard(room_id)
+            journal.archive(room_id)
+            games.discard(room_id)
+            market_feed.discard(room_id)
+            room_codecs.pop(room_id, None)
+            lobby_cache.invalidate()
+            return jsonify({"message": "Room deleted because no players are left"}), 200
+
+        if left["new_host"]:
+            # Notify all players about the new host
+            socketio.emit('update_host', {
+                "roomId": room_id,
+                "newHost": left["new_host"]
+            }, room=room_id)
+
+            # Log the new host in the game log
+            socketio.emit('player_left', {
+                "roomId": room_id,
+                "username": username,
+                "num_players": left["num_players"],
+                "newHost": left["new_host"]
+            }, room=room_id)
+
+        # Update the lobby summary
+        store.patch(room_id, {"$set": left["summary"]})
+        lobby_cache.invalidate()
 
         # Notify all clients in the room about the player leaving
         socketio.emit('player_left', {
-            "roomId": str(room["_id"]),
+            "roomId": room_id,
             "username": username,
-            "num_players": game.player_count
-        }, room=str(room["_id"]))
+            "num_players": left["num_players"]
+        }, room=room_id)
 
         return jsonify({"message": "Player removed"}), 200
             
@@ -381,216 +593,476 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     print('Client disconnected')
+    # Frees the player names this socket registered for private views with each room's owner
+    for room in socketio.server.rooms(request.sid):
+        room_id, _, market = room.partition(':market:')
+        if market:
+            dispatch_event('unregister_player', room_id, {"roomId": room_id}, request.sid)
+
+@socketio.on('subscribe_lobby')
+def handle_subscribe_lobby():
+    # Sends the current listing once, after that only lobby_update diffs. Socket.IO rooms
+    # are per worker, so the socket joins here and only the snapshot comes from the
+    # lobby's owner, whose version sequence the diffs follow
+    socketio.server.enter_room(sid=request.sid, room=LOBBY)
+    dispatch_event('lobby_snapshot', LOBBY, {}, request.sid)
+
+@room_event('lobby_snapshot', key=lambda data: LOBBY)
+def handle_lobby_snapshot(data, sid):
+    rooms, version = lobby_cache.get()
+    socketio.emit('lobby_snapshot', {"version": version, "rooms": rooms}, to=sid)
+
+@socketio.on('unsubscribe_lobby')
+def handle_unsubscribe_lobby():
+    socketio.server.leave_room(sid=request.sid, room=LOBBY)
 
 @socketio.on('join_room')
 def handle_join_room(data):
     print("Client joining room")
     room_id = data.get('roomId')
     username = data.get('username')
+    protocol = 2 if data.get('protocol') == 2 else 1
+    codec = negotiate(data.get('codec'))
     if room_id:
         socketio.server.enter_room(sid=request.sid, room=room_id)
+        socketio.server.enter_room(sid=request.sid, room=market_room(room_id, protocol, codec))
         print(f"Client {username} joined room: {room_id}")
         emit('joined_room', {"roomId": room_id, "username": username}, room=room_id)
+        if codec != "json":
+            # The room's owner only encodes games with the codecs its sockets asked for
+            dispatch_event('use_codec', room_id, {"roomId": room_id, "codec": codec}, request.sid)
+        if username:
+            # The room's owner sends this socket the player's private views
+            dispatch_event('register_player', room_id, {"roomId": room_id, "username": username}, request.sid)
+        # Acknowledgement with what was negotiated, for clients that passed a callback
+        return {"protocol": protocol, "codec": codec}
+
+@room_event('use_codec')
+def handle_use_codec(data, sid):
+    codec = negotiate(data.get('codec'))
+    if codec != "json":
+        room_codecs.setdefault(data.get('roomId'), set()).add(codec)
+
+@room_event('register_player')
+def handle_register_player(data, sid):
+    if not market_feed.register(data.get('roomId'), data.get('username'), sid):
+        socketio.emit('error', {'message': 'Another connection is already playing as this user, '
+                                           'this one takes over when it disconnects.'}, to=sid)
+
+@room_event('unregister_player')
+def handle_unregister_player(data, sid):
+    room_id = data.get('roomId')
+    for username, player_sid in market_feed.unregister(room_id, sid):
+        # The socket that took the name over only has the public views so far
+        def overlay(game, username=username):
+            return serialize_views(game)[1].get(username), None
+
+        def reply(view, username=username):
+            if view is not None:
+                market_feed.send_view(room_id, username, view)
 
-@socketio.on('start_game')
-def handle_start_game(data):
+        submit(room_id, overlay, reply)
+
+@room_event('market_snapshot')
+def handle_market_snapshot(data, sid):
+    # A protocol 2 client that saw a gap in the feed, or just arrived, catches up from here
+    room_id = data.get('roomId')
+    codec = CODECS[negotiate(data.get('codec'))]
+
+    def snapshot(game):
+        public, private = serialize_views(game)
+        # Only the player this socket joined as gets their own overlay
+        return {"game": codec.encode(public), "top": top_of_book(game),
+                "private": private.get(market_feed.username(room_id, sid))}, None
+
+    def reply(result):
+        if result is None:
+            socketio.emit('error', {'message': 'Room not found.'}, to=sid)
+            return
+        market_feed.snapshot(room_id, lambda message: socketio.emit('market_snapshot', message, to=sid), result)
+
+    submit(room_id, snapshot, reply)
+
+@room_event('start_game')
+def handle_start_game(data, sid):
     room_id = data.get('roomId')
     print(f"Starting game for room: {room_id}")
 
-    game = deserialize_game(rooms_collection.find_one({"_id": ObjectId(room_id)}).get("game", {}))
-    game.start_game()
+    def start(game):
+        game.start_game()
+        return (serialize_game(game), serialize_views(game)), ("start_game", {"fair_value": game.fair_value, "round": game.current_round})
+
+    def reply(result):
+        if result is None:
+            socketio.emit('error', {'message': 'Room not found.'}, to=sid)
+            return
+        game_data, (public, private) = result
 
-    game_data = serialize_game(game)
+        # Emit the start_game event to all clients in the room, the waiting screen of either protocol reads it
+        emit_game('start_game', room_id, game_data)
+        emit_game('start_game', room_id, public, protocols=(2,))
+        market_feed.send(room_id, 'round_update', {"event": "start_game", "game": public}, private=private)
 
-    # Emit the start_game event to all clients in the room
-    socketio.emit('start_game', {
-        "roomId": room_id,
-        "gameData": json.dumps(game_data)  # Ensure game_data is a JSON string
-    }, room=room_id)
+    submit(room_id, start, reply)
     
 
-@socketio.on('start_round')
-def start_round_event(data):
+@room_event('start_round')
+def start_round_event(data, sid):
     room_id = data.get('roomId')
     print(f"Starting new round for room: {room_id}")
 
-    room_doc = rooms_collection.find_one({"_id": ObjectId(room_id)})
-    if not room_doc:
-        print("Room not found.")
-        return
+    def start_round(game):
+        game.start_new_round()  # Use the revised method to force a new round
+        return (serialize_game(game), serialize_views(game)), ("start_round", {"fair_value": game.fair_value, "round": game.current_round})
 
-    game = deserialize_game(room_doc.get("game", {}))
-    game.start_new_round()  # Use the revised method to force a new round
+    def reply(result):
+        if result is None:
+            socketio.emit('error', {'message': 'Room not found.'}, to=sid)
+            return
 
-    rooms_collection.update_one(
-        {"_id": ObjectId(room_id)},
-        {"$set": {"game": serialize_game(game)}}
-    )
+        broadcast_round(room_id, 'start_round', *result)
 
-    game_data = serialize_game(game)
-    socketio.emit('start_round', {
-        "roomId": room_id,
-        "gameData": json.dumps(game_data)
-    }, room=room_id)
+    submit(room_id, start_round, reply)
     
-@socketio.on('make_market')
-def handle_make_market(data):
+@room_event('make_market')
+def handle_make_market(data, sid):
     room_id = data.get("roomId")
     player_name = data.get("playerName")
     action = data.get("action")
     number = data.get("number")
+    size = data.get("size", 1)
+
+    def make_market(game):
+        # Execute make_the_market
+        result = game.make_the_market(player_name, action, number, size)
+        if not result["success"]:
+            return result, None
+        top = top_of_book(game)
+        return dict(result, top=top, update={
+            "success": True,
+            "action": action,
+            "number": number,
+            **top,
+            "logMessage": result["message"],  # Include the log message
+        }), ("make_market", {"player": player_name, "action": action, "number": number, "size": size})
 
-    # Fetch room and game
-    room = rooms_collection.find_one({"_id": ObjectId(room_id)})
-    if not room:
-        emit("market_update", {"success": False, "message": "Room not found"})
-        return
+    def reply(result):
+        if result is None:
+            socketio.emit("market_update", {"success": False, "message": "Room not found"}, to=sid)
+            return
 
-    game = deserialize_game(room.get("game", {}))
+        # Notify players
+        if result["success"]:
+            broadcast_market(room_id, result)
+            print("runs")
+        else:
+            socketio.emit("market_update", result, to=sid)
+            print("runs!")
 
-    # Execute make_the_market
-    result = game.make_the_market(player_name, action, number)
+    submit(room_id, make_market, reply)
 
-    # Update database and notify players
-    if result["success"]:
-        rooms_collection.update_one(
-            {"_id": ObjectId(room_id)},
-            {"$set": {"game": serialize_game(game)}}
-        )
-        socketio.emit("market_update", {
+@room_event('cancel_market')
+def handle_cancel_market(data, sid):
+    room_id = data.get("roomId")
+    player_name = data.get("playerName")
+    action = data.get("action")
+
+    def cancel_market(game):
+        result = game.cancel_the_market(player_name, action)
+        if not result["success"]:
+            return result, None
+        top = top_of_book(game)
+        return dict(result, top=top, update={
             "success": True,
-            "action": action,
-            "number": number,
-            "currentBid": game.current_bid,
-            "currentAsk": game.current_ask,
-            "bidPlayer": game.bid_player.name if game.bid_player else None,
-            "askPlayer": game.ask_player.name if game.ask_player else None,
-            "logMessage": result["message"],  # Include the log message
-        }, room=room_id)
-        print("runs")
-    else:
-        emit("market_update", result)
-        print("runs!")
-@socketio.on('take_market')
-def handle_take_market(data):  # update!
+            "action": "cancel",
+            "side": action,
+            "playerName": player_name,
+            **top,
+            "logMessage": result["message"],
+        }), ("cancel_market", {"player": player_name, "action": action})
+
+    def reply(result):
+        if result is None:
+            socketio.emit("market_update", {"success": False, "message": "Room not found"}, to=sid)
+            return
+
+        if result["success"]:
+            broadcast_market(room_id, result)
+        else:
+            socketio.emit("market_update", result, to=sid)
+
+    submit(room_id, cancel_market, reply)
+
+@room_event('take_market')
+def handle_take_market(data, sid):  # update!
     room_id = data.get("roomId")  # update!
     player_name = data.get("playerName")  # update!
     action = data.get("action")  # update!
 
-    room = rooms_collection.find_one({"_id": ObjectId(room_id)})  # update!
-    if not room:  # update!
-        emit("market_update", {"success": False, "message": "Room not found"})  # update!
-        return  # update!
+    def take_market(game):
+        target_player = game.bid_player if action=="hit" else game.ask_player  # update!
+        price = game.current_bid if action=="hit" else game.current_ask  # update!
 
-    game = deserialize_game(room.get("game", {}))  # update!
-    target_player = game.bid_player if action=="hit" else game.ask_player  # update!
-    price = game.current_bid if action=="hit" else game.current_ask  # update!
-
-    result = game.take_the_market(player_name, action)  # update!
-
-    if result["success"]:  # update!
-         target_name = target_player.name if target_player else None  # update!
-         rooms_collection.update_one(  # update!
-            {"_id": ObjectId(room_id)},
-            {"$set": {"game": serialize_game(game)}}
-         )  # update!
-         socketio.emit("market_update", {  # update!
+        result = game.take_the_market(player_name, action)  # update!
+        if not result["success"]:
+            return result, None
+        target_name = target_player.name if target_player else None  # update!
+        buyer, seller = (target_name, player_name) if action == "hit" else (player_name, target_name)
+        return dict(result, top=top_of_book(game), update={
             "success": True,
             "action": action,
             "price": price,
             "playerName": player_name,
             "bidPlayer": target_name if action=="hit" else None,
             "askPlayer": target_name if action=="lift" else None,
+            "currentBid": game.current_bid,
+            "currentAsk": game.current_ask,
+            "depth": game.market_depth(),
             "logMessage": result["message"],
-        }, room=room_id)  # update!
-    else:
-        emit("market_update", result)  # update!
+        }, trade={"buyer": buyer, "seller": seller, "price": price},
+           players=player_counters(game, buyer, seller)), ("take_market", {"player": player_name, "action": action, "price": price})
+
+    def reply(result):
+        if result is None:  # update!
+            socketio.emit("market_update", {"success": False, "message": "Room not found"}, to=sid)  # update!
+            return  # update!
+
+        if result["success"]:  # update!
+            broadcast_market(room_id, result)  # update!
+        else:
+            socketio.emit("market_update", result, to=sid)  # update!
+
+    submit(room_id, take_market, reply)
 
-@socketio.on('place_ask')
-def handle_place_ask(data):
+@room_event('place_ask')
+def handle_place_ask(data, sid):
     room_id = data.get('roomId')
     username = data.get('username')
     value = int(data.get('value'))
 
-    room_data = rooms_collection.find_one({"_id": ObjectId(room_id)})
-    if not room_data:
-        print(f"Room {room_id} not found.")
-        emit('error', {'message': 'Room not found.'}, to=request.sid)
-        return
+    def place_ask(game):
+        # Validate and update the ask
+        result = game.place_ask(username, value)
+        if not result["success"]:
+            return result, None
+        return dict(result, current_ask=game.current_ask, top=top_of_book(game)), ("place_ask", {"player": username, "value": value})
+
+    def reply(result):
+        if result is None:
+            print(f"Room {room_id} not found.")
+            socketio.emit('error', {'message': 'Room not found.'}, to=sid)
+            return
+        if not result["success"]:
+            socketio.emit('error', {'message': result["message"]}, to=sid)
+            return
+
+        # Broadcast the updated market and log to all players
+        socketio.emit('update_market', {
+            'action': 'ask',
+            'value': value,
+            'player': username,
+            'currentAsk': result["current_ask"],
+            'logMessage': f"{username} has placed an ask for ${value}."
+        }, to=market_rooms(room_id, 1))
+        market_feed.publish(room_id, result["top"], result["message"])
+
+        print(f"Player {username} placed an ask of ${value}.")
+
+    submit(room_id, place_ask, reply)
+    
+def end_round(game, round_pnls=None):
+    game.end_round(round_pnls=round_pnls)  # Call the end_round method from game_logic
+    return (serialize_game(game), serialize_views(game)), ("end_round", {"timer": game.timer})
 
-    game = deserialize_game(room_data.get("game", {}))
+@room_event('end_round')
+def handle_end_round(data, sid):
+    room_id = data.get('roomId')
+    print("Ending round for room:", room_id)
+    
+    def reply(result):
+        if result is None:
+            socketio.emit('error', {'message': 'Room not found.'}, to=sid)
+            return
+
+        # Emit the end_round event to all players in the room
+        broadcast_round(room_id, 'end_round', *result)
+
+    # End the round and update the room data
+    submit(room_id, end_round, reply)
+
+def end_rounds(room_ids, timeout=10):
+    """
+    Ends the current round in many rooms at once, e.g. at a tournament round
+    boundary: rooms that aren't live are loaded with one query, all of them
+    are settled together, their changes are written with one bulk write and
+    then every room gets its end_round event. Returns the settled room ids.
+
+    Settlement takes its place in each room's actor queue like any other
+    command: commands queued before the boundary are applied first, the ones
+    queued after it wait until the round is settled.
+    """
+    room_ids = sorted(games.get_many([room_id for room_id in dict.fromkeys(room_ids) if valid_room_id(room_id)]))
+    arrived = {room_id: threading.Event() for room_id in room_ids}
+    settled_event = threading.Event()
+    payloads = {}
+
+    def barrier(room_id):
+        # Runs on the room's actor once everything queued before it is applied
+        arrived[room_id].set()
+        settled_event.wait()
+        return payloads.get(room_id)
+
+    def reply(room_id, payload):
+        if payload is not None:
+            broadcast_round(room_id, 'end_round', *payload)
+
+    for room_id in room_ids:
+        actors.submit(room_id, lambda room_id=room_id: barrier(room_id),
+                      lambda payload, room_id=room_id: reply(room_id, payload))
 
-    # Validate the ask
-    if value >= game.current_ask:
-        emit('error', {'message': 'Ask must be less than the current ask.'}, to=request.sid)
-        return
+    try:
+        deadline = time.monotonic() + timeout
+        for event in arrived.values():
+            event.wait(max(0, deadline - time.monotonic()))
+        # A room whose queue didn't drain in time is left for a later call
+        ready = [room_id for room_id in room_ids if arrived[room_id].is_set()]
+
+        # Locks are always taken in room id order so two batches can't deadlock
+        with ExitStack() as stack:
+            for room_id in ready:
+                stack.enter_context(games.lock(room_id))
+
+            # Rooms rebased or ended while we waited are re-read, the batch settles whatever is live now
+            settled = [room_id for room_id in ready if room_id in games]
+            batch = [games.games[room_id] for room_id in settled]
+            if settlement.available():
+                batch_pnls = settlement.round_pnls(batch)
+            else:
+                batch_pnls = [None] * len(batch)
+
+            results = {}
+            for room_id, game, round_pnls in zip(settled, batch, batch_pnls):
+                game_data, (event_type, data) = end_round(game, round_pnls)
+                # Kept as a plain end_round, a replay after a conflict settles against the state it lands on
+                games.record_command(room_id, end_round)
+                persistence.mark_dirty(room_id)
+                journal.record(room_id, game, event_type, **data)
+                results[room_id] = game_data
+
+        persistence.flush(settled)
+        payloads.update(results)
+    finally:
+        # Each room's actor sends its end_round and goes on with the commands queued after it
+        settled_event.set()
+    return settled
+
+@app.route('/tournament/end-round', methods=['POST'])
+def tournament_end_round():
+    data = request.json
+    room_ids = data.get('roomIds') or []
 
-    # Update the ask
-    game.current_ask = value
-    game.ask_player = next((p for p in game.players if p.name == username), None)
+    if not room_ids:
+        return jsonify({"message": "roomIds is required"}), 400
 
-    if game.ask_player:
-        game.ask_player.record.append(['ask', value])
-    else:
-        emit('error', {'message': 'Player not found.'}, to=request.sid)
-        return
+    try:
+        # Each worker settles its own rooms, the others are asked over HTTP
+        local = [room_id for room_id in room_ids if shards.is_local(room_id)]
+        settled = end_rounds(local)
+        by_owner = {}
+        for room_id in room_ids:
+            if not shards.is_local(room_id):
+                by_owner.setdefault(shards.owner(room_id), []).append(room_id)
+        for owner, owned in by_owner.items():
+            response = forward_request(owned[0], path='/tournament/end-round', payload={"roomIds": owned})
+            if response is not None and response.status_code == 200:
+                settled += response.get_json()["settled"]
+        missing = [room_id for room_id in room_ids if room_id not in settled]
+        return jsonify({"message": "Rounds ended", "settled": settled, "missing": missing}), 200
+    except Exception as e:
+        return jsonify({"message": str(e)}), 500
 
-    # Serialize and save the updated game state
-    rooms_collection.update_one(
-        {"_id": ObjectId(room_id)},
-        {"$set": {"game": serialize_game(game)}}
-    )
-
-    # Broadcast the updated market and log to all players
-    socketio.emit('update_market', {
-        'action': 'ask',
-        'value': value,
-        'player': username,
-        'currentAsk': game.current_ask,
-        'logMessage': f"{username} has placed an ask for ${value}."
-    }, room=room_id)
-
-    print(f"Player {username} placed an ask of ${value}.")
-    
-@socketio.on('end_round')
-def handle_end_round(data):
-    room_id = data.get('roomId')
-    print("Ending round for room:", room_id)
-    
-    # Retrieve the room document from the database
-    room_doc = rooms_collection.find_one({"_id": ObjectId(room_id)})
-    if not room_doc:
-        print("Room not found for end_round")
-        return
-    
-    # Deserialize game state, end the round, and update the room data
-    game = deserialize_game(room_doc.get("game", {}))
-    game.end_round()  # Call the end_round method from game_logic
-    rooms_collection.update_one(
-        {"_id": ObjectId(room_id)},
-        {"$set": {"game": serialize_game(game)}}
-    )
-    
-    # Emit the end_round event to all players in the room
-    game_data = serialize_game(game)
-    socketio.emit('end_round', {
-        "roomId": room_id,
-        "gameData": json.dumps(game_data)
-    }, room=room_id)  # update! Emit to all players in the room
-
-@socketio.on('end_game')
-def handle_end_game(data):
+@room_event('end_rounds', key=lambda data: None)
+def handle_end_rounds(data, sid):
+    room_ids = data.get('roomIds') or []
+    print(f"Ending round for {len(room_ids)} rooms")
+
+    # Each worker settles its own rooms
+    by_owner = {}
+    for room_id in room_ids:
+        by_owner.setdefault(shards.owner(room_id), []).append(room_id)
+    for owner, owned in by_owner.items():
+        if owner == shards.worker_id:
+            end_rounds(owned)
+        else:
+            forward_event(owner, 'end_rounds', {"roomIds": owned}, sid)
+
+@room_event('end_game')
+def handle_end_game(data, sid):
     room_id = data.get('roomId')
     message = data.get('message', 'The game has ended.')
 
-    # Notify all players in the room that the game has ended
-    socketio.emit('game_ended', {
-        "roomId": room_id,
-        "message": message
-    }, room=room_id)
+    def end_game():
+        # Write out the final state before the room goes away
+        persistence.flush([room_id])
+        journal.archive(room_id)
+
+        # Optionally, you can delete the room from the database here
+        store.delete(room_id)
+        games.discard(room_id)
+        market_feed.discard(room_id)
+        room_codecs.pop(room_id, None)
+        lobby_cache.invalidate()
+
+    def reply(_):
+        # Notify all players in the room that the game has ended
+        socketio.emit('game_ended', {
+            "roomId": room_id,
+            "message": message
+        }, room=room_id)
 
-    # Optionally, you can delete the room from the database here
-    rooms_collection.delete_one({"_id": ObjectId(room_id)})
+    if not room_exists(room_id):
+        socketio.emit('error', {'message': 'Room not found.'}, to=sid)
+        return
+    # Queued behind the room's pending commands so they still make it into the final state
+    actors.submit(room_id, end_game, reply)
+
+# Seconds a room may go unused before it is dropped from memory, once all its changes are written
+ROOM_IDLE_TIMEOUT = int(os.environ.get('ROOM_IDLE_TIMEOUT', 1800))
+
+def evict_idle_rooms(interval=60):
+    """
+    Background loop that drops abandoned rooms (nobody ended or left them)
+    from the registry, the feed and the journal's bookkeeping. A room that
+    is used again is loaded from the database like after a restart.
+    """
+    while True:
+        socketio.sleep(interval)
+        try:
+            evicted = games.evict_idle(ROOM_IDLE_TIMEOUT, persistence.is_written)
+        except Exception as e:
+            print(f"Evicting idle rooms failed: {e}")
+            continue
+        for room_id in evicted:
+            journal.forget(room_id)
+            # Sockets may still be in the room, its feed and codecs stay until none is registered
+            if market_feed.evict(room_id):
+                room_codecs.pop(room_id, None)
+        if evicted:
+            print(f"Evicted {len(evicted)} idle rooms")
+
+socketio.start_background_task(evict_idle_rooms)
+
+def shutdown(signum, frame):
+    # workers.py and Heroku stop the server with SIGTERM, which skips atexit
+    print("SIGTERM received, writing out pending rooms")
+    persistence.close()
+    journal.close()
+    sys.exit(0)
 
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True)
+    store.prepare()
+    signal.signal(signal.SIGTERM, shutdown)
+    # The reloader would start a second copy of a worker next to the launcher's,
+    # and doesn't mix with a monkey patched standard library
+    socketio.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), debug=True,
+                 use_reloader=len(shards.workers) == 1 and concurrency.mode == 'threading')
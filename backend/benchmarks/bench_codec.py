@@ -0,0 +1,97 @@
+"""
+Size and speed of the game payload codecs.
+
+Builds rooms of increasing size with a played-out round, checks that every
+codec round-trips them (game data and the Game rebuilt from it), then
+compares each codec with the current JSON path, where gameData is a
+json.dumps string that Socket.IO encodes a second time. BSON is listed for
+the size of the stored document.
+
+Run from the backend folder:
+    python benchmarks/bench_codec.py
+"""
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bson
+
+from codec import CODECS, decode_game
+from game_logic import Game, Player
+from serialization import serialize_game
+
+
+def make_game(players, trades, seed=3):
+    rng = random.Random(seed)
+    game = Game()
+    for i in range(players):
+        game.player_join(Player(f"player{i}"))
+    game.set_host("player0")
+    game.start_game()
+    names = [player.name for player in game.players]
+    for _ in range(trades):
+        maker, taker = rng.sample(names, 2)
+        if rng.random() < 0.5:
+            game.make_the_market(maker, "bid", rng.randint(max(game.current_bid + 1, 1), 20) if game.current_bid < 20 else 20)
+            game.take_the_market(taker, "hit")
+        else:
+            game.make_the_market(maker, "ask", rng.randint(1, min(game.current_ask - 1, 20)) if game.current_ask > 1 else 1)
+            game.take_the_market(taker, "lift")
+    return game
+
+
+def check_round_trip(game):
+    game_data = serialize_game(game)
+    for name, codec in CODECS.items():
+        assert codec.decode(codec.encode(game_data)) == game_data, f"{name} changed the game data"
+        rebuilt = decode_game(codec.encode(game_data), name)
+        assert serialize_game(rebuilt) == game_data, f"{name} changed the rebuilt game"
+
+
+def timed(function, argument, repeat):
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function(argument)
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return best
+
+
+def main():
+    formats = {
+        # gameData as a JSON string inside the Socket.IO message, i.e. encoded twice
+        "json string": (lambda data: json.dumps({"gameData": json.dumps(data)}),
+                        lambda payload: json.loads(json.loads(payload)["gameData"])),
+        "bson": (bson.encode, bson.decode),
+    }
+    for name, codec in CODECS.items():
+        if codec.binary:
+            formats[name] = (codec.encode, codec.decode)
+        else:
+            formats[name] = (lambda data, codec=codec: json.dumps({"gameData": codec.encode(data)}),
+                             lambda payload, codec=codec: codec.decode(json.loads(payload)["gameData"]))
+
+    print(f"{'room':<18}{'format':<14}{'bytes':>10}{'encode us':>12}{'decode us':>12}")
+    for players, trades in [(4, 20), (10, 200), (10, 2000)]:
+        with contextlib.redirect_stdout(io.StringIO()):  # Game prints the round setup
+            game = make_game(players, trades)
+        check_round_trip(game)
+        game_data = serialize_game(game)
+        repeat = max(10, 20000 // (players + trades))
+        for name, (encode, decode) in formats.items():
+            payload = encode(game_data)
+            encode_time = timed(encode, game_data, repeat)
+            decode_time = timed(decode, payload, repeat)
+            label = f"{players}p/{trades}t"
+            print(f"{label:<18}{name:<14}{len(payload):>10,}{encode_time * 1e6:>12.1f}{decode_time * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Loading a stored room into a live game.
+
+What a registry miss costs: deserialize_game on the stored document followed
+by the serialize_game every handler ends with. Player records stay in their
+stored form until something reads them, so it is timed once as handlers see
+it and once with every record built right after loading, which is what
+deserialize_game used to do. The reloaded game is checked against the
+original, before and after a trade.
+
+Run from the backend folder:
+    python benchmarks/bench_load.py
+"""
+import contextlib
+import copy
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_codec import make_game
+from serialization import serialize_game, serialize_views, deserialize_game, build_update
+
+
+def load(document, build_records):
+    game = deserialize_game(document)
+    if build_records:
+        for player in game.players:
+            player.record
+    serialize_game(game)
+    return game
+
+
+def check(game):
+    game_data = serialize_game(game)
+    rebuilt = deserialize_game(copy.deepcopy(game_data))
+    assert serialize_game(rebuilt) == game_data, "reloaded game differs"
+    assert serialize_views(rebuilt) == serialize_views(game), "reloaded views differ"
+
+    for room in (game, rebuilt):
+        room.mark_clean()
+        with contextlib.redirect_stdout(io.StringIO()):
+            room.make_the_market(room.players[0].name, "ask", 1)
+            room.take_the_market(room.players[1].name, "lift")
+    assert build_update(rebuilt) == build_update(game), "reloaded game writes a different update"
+    assert serialize_game(rebuilt) == serialize_game(game), "reloaded game differs after a trade"
+
+
+def timed(document, build_records, repeat):
+    best = float("inf")
+    for _ in range(3):
+        documents = [copy.deepcopy(document) for _ in range(repeat)]
+        start = time.perf_counter()
+        for document_copy in documents:
+            load(document_copy, build_records)
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return best
+
+
+def main():
+    print(f"{'room':<14}{'eager us':>10}{'lazy us':>10}{'speedup':>10}")
+    for players, trades in [(4, 20), (10, 200), (10, 2000)]:
+        with contextlib.redirect_stdout(io.StringIO()):  # Game prints the round setup
+            game = make_game(players, trades)
+        check(game)
+        document = serialize_game(game)
+        repeat = max(10, 20000 // (players + trades))
+        eager = timed(document, True, repeat)
+        lazy = timed(document, False, repeat)
+        print(f"{f'{players}p/{trades}t':<14}{eager * 1e6:>10.1f}{lazy * 1e6:>10.1f}{eager / lazy:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Micro-benchmark of the quote engines behind Game.
+
+Compares the old single-slot current_bid/current_ask fields with the heap
+book and the bucket book on the same random stream of quotes, hits, lifts
+and cancels, and measures the memory of many idle books. The two books are
+first checked to agree on every step of the stream.
+
+Run from the backend folder:
+    python benchmarks/bench_order_book.py
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from order_book import OrderBook, BucketOrderBook
+
+
+class ScalarQuotes:
+    """
+    The single best bid/ask slots Game used before the order book.
+    """
+    def __init__(self):
+        self.current_bid = 0
+        self.current_ask = 21
+        self.bid_player = None
+        self.ask_player = None
+
+    def place(self, player_name, side, price, size=1):
+        if side == "bid":
+            self.current_bid = price
+            self.bid_player = player_name
+        else:
+            self.current_ask = price
+            self.ask_player = player_name
+
+    def cancel_player(self, player_name, side=None):
+        if side == "bid" and self.bid_player == player_name:
+            self.current_bid, self.bid_player = 0, None
+        elif side == "ask" and self.ask_player == player_name:
+            self.current_ask, self.ask_player = 21, None
+
+    def fill(self, side, size=1):
+        if side == "bid":
+            self.current_bid, self.bid_player = 0, None
+        else:
+            self.current_ask, self.ask_player = 21, None
+
+    def best_prices(self):
+        return self.current_bid, self.current_ask
+
+
+def book_prices(book):
+    best_bid = book.best_bid()
+    best_ask = book.best_ask()
+    return (best_bid.price if best_bid else 0), (best_ask.price if best_ask else 21)
+
+
+def make_workload(operations, players=10, seed=7):
+    rng = random.Random(seed)
+    names = [f"player{i}" for i in range(players)]
+    workload = []
+    for _ in range(operations):
+        roll = rng.random()
+        name = rng.choice(names)
+        side = rng.choice(["bid", "ask"])
+        if roll < 0.6:
+            workload.append(("place", name, side, rng.randint(1, 20)))
+        elif roll < 0.8:
+            workload.append(("fill", name, side, 0))
+        else:
+            workload.append(("cancel", name, side, 0))
+    return workload
+
+
+def check_engines(workload):
+    heap, bucket = OrderBook(), BucketOrderBook()
+    rng = random.Random(3)
+    for kind, name, side, price in workload:
+        size = rng.randint(1, 5)
+        if kind == "place":
+            results = [book.place(name, side, price, size).to_list() for book in (heap, bucket)]
+        elif kind == "fill":
+            results = [(order and order.to_list(), filled) for order, filled in (book.fill(side, size) for book in (heap, bucket))]
+        else:
+            results = [[order.to_list() for order in book.cancel_player(name, side)] for book in (heap, bucket)]
+        assert results[0] == results[1], f"{kind} differs: {results}"
+        for book_side in ("bid", "ask"):
+            assert heap.depth(book_side) == bucket.depth(book_side), "depth differs"
+        assert dict(heap.to_dict(), engine=None) == dict(bucket.to_dict(), engine=None), "saved books differ"
+    assert BucketOrderBook.from_dict(bucket.to_dict()).to_dict() == bucket.to_dict(), "bucket book doesn't round-trip"
+
+
+def run(factory, workload, prices):
+    book = factory()
+    start = time.perf_counter()
+    for kind, name, side, price in workload:
+        if kind == "place":
+            book.place(name, side, price)
+        elif kind == "fill":
+            book.fill(side)
+        else:
+            book.cancel_player(name, side)
+        # Game reads the top of the book after every change
+        prices(book)
+    return time.perf_counter() - start
+
+
+def measure_memory(factory, count, workload):
+    tracemalloc.start()
+    books = []
+    for _ in range(count):
+        book = factory()
+        for kind, name, side, price in workload:
+            if kind == "place":
+                book.place(name, side, price)
+        books.append(book)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / count
+
+
+def main():
+    workload = make_workload(200_000)
+    resting = make_workload(40, seed=11)
+    check_engines(workload[:20_000])
+    engines = [
+        ("scalar fields", ScalarQuotes, ScalarQuotes.best_prices),
+        ("heap book", OrderBook, book_prices),
+        ("bucket book", BucketOrderBook, book_prices),
+    ]
+
+    print(f"{'engine':<15}{'ops/s':>12}{'us/op':>10}{'bytes/book':>14}")
+    for name, factory, prices in engines:
+        elapsed = min(run(factory, workload, prices) for _ in range(3))
+        memory = measure_memory(factory, 1000, resting)
+        print(f"{name:<15}{len(workload) / elapsed:>12,.0f}{elapsed / len(workload) * 1e6:>10.2f}{memory:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
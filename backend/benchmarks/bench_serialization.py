@@ -0,0 +1,79 @@
+"""
+serialize_game with and without its cache.
+
+Plays trades in a room and serializes the game after each one, the way
+handlers do per event: once with the memoized serializer and once with the
+caches dropped before every call, i.e. a full rebuild. Both results are
+compared on every call.
+
+Run from the backend folder:
+    python benchmarks/bench_serialization.py
+"""
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from game_logic import Game, Player
+from serialization import serialize_game, serialize_views
+
+
+def make_game(players, seed=5):
+    game = Game()
+    for i in range(players):
+        game.player_join(Player(f"player{i}"))
+    game.set_host("player0")
+    with contextlib.redirect_stdout(io.StringIO()):  # Game prints the round setup
+        game.start_game()
+    return game, random.Random(seed)
+
+
+def trade(game, rng):
+    names = [player.name for player in game.players]
+    maker, taker = rng.sample(names, 2)
+    game.make_the_market(maker, "ask", max(1, game.current_ask - 1))
+    game.take_the_market(taker, "lift")
+    if game.current_ask <= 2:
+        game.book.clear()
+        game.sync_quotes()
+
+
+def drop_caches(game):
+    game._serialized = None
+    for player in game.players:
+        player._serialized = None
+
+
+def run(players, trades, cached):
+    game, rng = make_game(players)
+    for _ in range(trades):
+        trade(game, rng)
+    elapsed = 0
+    for _ in range(200):
+        trade(game, rng)
+        if not cached:
+            drop_caches(game)
+        start = time.perf_counter()
+        game_data = serialize_game(game)
+        serialize_views(game)
+        elapsed += time.perf_counter() - start
+        if cached:
+            drop_caches(game)
+            assert serialize_game(game) == game_data, "cached serialize_game differs from a full rebuild"
+    return elapsed / 200
+
+
+def main():
+    print(f"{'room':<14}{'full us':>10}{'cached us':>12}{'speedup':>10}")
+    for players, trades in [(4, 20), (10, 200), (10, 2000)]:
+        full = run(players, trades, cached=False)
+        cached = run(players, trades, cached=True)
+        print(f"{f'{players}p/{trades}t':<14}{full * 1e6:>10.1f}{cached * 1e6:>12.1f}{full / cached:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import itertools
+import threading
+import time
+
+
+class MarketBatcher:
+    """
+    Per-room outbound feed for protocol 2 clients.
+
+    Clients that joined a room with protocol 2 don't get one market_update
+    per quote, cancel or trade: everything published for the room within one
+    interval goes out as a single market_batch holding the latest top of the
+    book, the trades, the players whose counters changed and the log lines in
+    between, so a quote storm costs each player one message per interval
+    instead of one per quote.
+
+    Every message of a room's feed carries the next sequence number of that
+    room and the feed's epoch, which changes when the process restarts or the
+    room's feed starts over after being evicted. A
+    client that sees a gap asks for a snapshot, which carries the sequence
+    number it is current as of.
+
+    What only one player may see goes to that player's socket alone, as a
+    player_view with the sequence number of the message it belongs to. That
+    is the only way it goes out, to sockets of either protocol.
+    """
+
+    def __init__(self, emit, emit_to, interval=0.025):
+        self.emit = emit  # emit(room_id, event, message) to the room's protocol 2 sockets
+        self.emit_to = emit_to  # emit_to(sid, event, message) to one socket
+        self.interval = interval
+        self.pending = {}  # room_id -> batch being filled
+        self.seqs = {}  # room_id -> sequence number of the last message sent
+        self.sids = {}  # room_id -> {username: sid} of the room's registered players
+        self.waiting = {}  # room_id -> {username: sid} refused while another socket had the name
+        self.epoch = format(int(time.time()), "x")
+        self.epochs = {}  # room_id -> epoch of the room's feed
+        self._feeds = itertools.count(1)
+        self._lock = threading.Lock()
+        # Held while numbering and emitting, so messages go out in sequence order
+        self._send_lock = threading.Lock()
+
+    def publish(self, room_id, top, log_message=None, trade=None, players=None):
+        with self._lock:
+            batch = self.pending.setdefault(room_id, {"roomId": room_id, "log": [], "trades": [], "players": {}})
+            batch["top"] = top
+            if log_message:
+                batch["log"].append(log_message)
+            if trade:
+                batch["trades"].append(trade)
+            if players:
+                batch["players"].update(players)
+
+    def register(self, room_id, username, sid):
+        """
+        Sends username's private views to sid from now on. Returns False if
+        another socket is registered as that player; the newest socket
+        refused for a name takes it over when that one unregisters.
+        """
+        with self._lock:
+            sids = self.sids.setdefault(room_id, {})
+            if sids.get(username, sid) != sid:
+                self.waiting.setdefault(room_id, {})[username] = sid
+                return False
+            sids[username] = sid
+            return True
+
+    def unregister(self, room_id, sid):
+        """
+        Frees the names sid was registered as. Returns the (username, sid)
+        pairs of the waiting sockets that took them over.
+        """
+        promoted = []
+        with self._lock:
+            sids = self.sids.get(room_id, {})
+            waiting = self.waiting.get(room_id, {})
+            for username in [username for username, waiting_sid in waiting.items() if waiting_sid == sid]:
+                del waiting[username]
+            for username in [username for username, player_sid in sids.items() if player_sid == sid]:
+                del sids[username]
+                if username in waiting:
+                    sids[username] = waiting.pop(username)
+                    promoted.append((username, sids[username]))
+            if not waiting:
+                self.waiting.pop(room_id, None)
+            if not sids:
+                self.sids.pop(room_id, None)
+        return promoted
+
+    def username(self, room_id, sid):
+        with self._lock:
+            return next((username for username, player_sid in self.sids.get(room_id, {}).items() if player_sid == sid), None)
+
+    def _epoch(self, room_id):
+        epoch = self.epochs.get(room_id)
+        if epoch is None:
+            epoch = self.epochs[room_id] = f"{self.epoch}.{next(self._feeds)}"
+        return epoch
+
+    def _send(self, room_id, event, message):
+        seq = self.seqs.get(room_id, 0) + 1
+        self.seqs[room_id] = seq
+        try:
+            self.emit(room_id, event, dict(message, seq=seq, epoch=self._epoch(room_id)))
+        except Exception as e:
+            print(f"{event} for room {room_id} failed: {e}")
+        return seq
+
+    def _send_pending(self, room_id):
+        with self._lock:
+            batch = self.pending.pop(room_id, None)
+        if batch:
+            self._send(room_id, "market_batch", batch)
+
+    def flush(self):
+        with self._send_lock:
+            with self._lock:
+                room_ids = list(self.pending)
+            for room_id in room_ids:
+                self._send_pending(room_id)
+        return len(room_ids)
+
+    def send(self, room_id, event, message, private=None):
+        """
+        Sends a message as part of the room's feed, after whatever market data
+        is still buffered. private maps usernames to the view that goes to
+        that player only, right after the message.
+        """
+        with self._send_lock:
+            self._send_pending(room_id)
+            seq = self._send(room_id, event, dict(message, roomId=room_id))
+            if not private:
+                return
+            self._send_views(room_id, seq, private)
+
+    def send_view(self, room_id, username, view):
+        """
+        Sends username's private view on its own, stamped with the room's
+        current sequence number, e.g. to a socket that just took the name over.
+        """
+        with self._send_lock:
+            self._send_pending(room_id)
+            self._send_views(room_id, self.seqs.get(room_id, 0), {username: view})
+
+    def _send_views(self, room_id, seq, private):
+        with self._lock:
+            sids = dict(self.sids.get(room_id, {}))
+        for username, view in private.items():
+            sid = sids.get(username)
+            if sid is None:
+                continue
+            try:
+                self.emit_to(sid, "player_view", {"roomId": room_id, "seq": seq, "epoch": self._epoch(room_id), "view": view})
+            except Exception as e:
+                print(f"player_view for {username} in room {room_id} failed: {e}")
+
+    def snapshot(self, room_id, reply, message):
+        """
+        Calls reply with message stamped with the room's current sequence
+        number; the client applies feed messages after that one.
+        """
+        with self._send_lock:
+            self._send_pending(room_id)
+            reply(dict(message, roomId=room_id, seq=self.seqs.get(room_id, 0), epoch=self._epoch(room_id)))
+
+    def discard(self, room_id):
+        with self._send_lock:
+            with self._lock:
+                self.pending.pop(room_id, None)
+                self.sids.pop(room_id, None)
+                self.waiting.pop(room_id, None)
+            self.seqs.pop(room_id, None)
+            self.epochs.pop(room_id, None)
+
+    def evict(self, room_id):
+        """
+        Drops the feed of an idle room unless a player is still registered
+        to it or something is waiting to be sent. Returns True if dropped.
+        """
+        with self._send_lock:
+            with self._lock:
+                if self.sids.get(room_id) or room_id in self.pending:
+                    return False
+                self.sids.pop(room_id, None)
+                self.waiting.pop(room_id, None)
+            self.seqs.pop(room_id, None)
+            self.epochs.pop(room_id, None)
+            return True
+
+    def run(self, sleep=time.sleep):
+        """
+        Background loop, meant to be started with socketio.start_background_task.
+        """
+        while True:
+            sleep(self.interval)
+            self.flush()
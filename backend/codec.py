@@ -0,0 +1,76 @@
+import json
+
+try:
+    import msgpack
+except ImportError:  # clients that ask for msgpack get JSON instead
+    msgpack = None
+
+from records import ACTION_CODES, ACTION_NAMES
+from serialization import serialize_game, deserialize_game
+
+
+class JsonCodec:
+    """
+    Game payloads as plain objects inside the Socket.IO JSON message, so they
+    are encoded once, together with the rest of the message.
+    """
+    name = "json"
+    binary = False
+
+    def encode(self, game_data):
+        return game_data
+
+    def decode(self, payload):
+        return json.loads(payload) if isinstance(payload, (str, bytes)) else payload
+
+
+class MsgpackCodec:
+    """
+    Game payloads as msgpack bytes, sent as a binary Socket.IO attachment.
+    A player's record goes as two columns, the one-byte action codes of
+    records.py as bytes and the prices, instead of [action name, price] pairs.
+    """
+    name = "msgpack"
+    binary = True
+
+    @staticmethod
+    def _pack_record(record):
+        if not record:
+            return [b"", []]
+        actions, prices = zip(*record)
+        return [bytes(map(ACTION_CODES.__getitem__, actions)), list(prices)]
+
+    def encode(self, game_data):
+        players = [
+            dict(player, record=self._pack_record(player["record"])) if "record" in player else player
+            for player in game_data.get("players", [])
+        ]
+        return msgpack.packb(dict(game_data, players=players), use_bin_type=True)
+
+    def decode(self, payload):
+        game_data = msgpack.unpackb(payload, raw=False)
+        for player in game_data.get("players", []):
+            if "record" in player:
+                codes, prices = player["record"]
+                player["record"] = [[ACTION_NAMES[code], price] for code, price in zip(codes, prices)]
+        return game_data
+
+
+CODECS = {"json": JsonCodec()}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+
+def negotiate(requested):
+    """
+    Codec name for what a client asked for, JSON unless it asked for one we have.
+    """
+    return requested if requested in CODECS else "json"
+
+
+def encode_game(game, name="json"):
+    return CODECS[name].encode(serialize_game(game))
+
+
+def decode_game(payload, name="json"):
+    return deserialize_game(CODECS[name].decode(payload))
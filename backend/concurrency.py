@@ -0,0 +1,41 @@
+"""
+Picks the server's concurrency model from ASYNC_MODE, before anything else
+is imported:
+
+- threading (default): one OS thread per connection.
+- gevent / eventlet: green threads. The standard library is monkey patched
+  here, so pymongo's sockets, locks and sleeps all yield to other green
+  threads and thousands of mostly idle websockets cost a few KB each instead
+  of a thread.
+
+app.py imports this module first; the room and game code is the same in
+every mode.
+"""
+
+import os
+
+mode = os.environ.get("ASYNC_MODE", "threading")
+
+if mode == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+elif mode == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+elif mode != "threading":
+    raise ValueError(f"Unknown ASYNC_MODE {mode}, expected threading, gevent or eventlet")
+
+
+def offload(fn, *args):
+    """
+    Runs blocking work the monkey patching doesn't cover, like file writes,
+    on a native thread in gevent / eventlet mode so the hub keeps serving
+    sockets meanwhile; in the calling thread otherwise.
+    """
+    if mode == "gevent":
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args)
+    if mode == "eventlet":
+        from eventlet import tpool
+        return tpool.execute(fn, *args)
+    return fn(*args)
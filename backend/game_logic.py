@@ -2,9 +2,70 @@ import random
 import time
 import datetime
 
+from order_book import new_book, MAX_SIZE
+from records import TradeRecord
+import settlement
+
+
+class ChangeTracker:
+    """
+    Remembers which persisted fields of an object changed since its last
+    database write, so that only those fields have to be sent to MongoDB.
+    Plain assignments are tracked automatically; counters are tracked as
+    increments so they can be written with $inc.
+
+    Changed fields are also collected separately for the serialization
+    cache, which takes them on its own schedule (see take_stale).
+    """
+    __slots__ = ()
+    tracked_fields = ()
+    counter_fields = ()
+
+    def __setattr__(self, name, value):
+        dirty = getattr(self, "_dirty", None)
+        if dirty is not None:
+            if name in self.counter_fields:
+                increments = self._increments
+                increments[name] = increments.get(name, 0) + value - getattr(self, name, 0)
+                self._stale.add(name)
+            elif name in self.tracked_fields:
+                dirty.add(name)
+                self._stale.add(name)
+        object.__setattr__(self, name, value)
+
+    def start_tracking(self):
+        self._stale = set()
+        self._serialized = None  # cached serialized form, see serialization.py
+        self._dirty = set()
+        self._increments = {}
+
+    def touch(self, name):
+        # For in-place changes (e.g. list appends) that __setattr__ can't see
+        self._dirty.add(name)
+        self._stale.add(name)
+
+    def take_stale(self):
+        """
+        Returns the fields changed since the previous call and starts over.
+        """
+        stale = self._stale
+        self._stale = set()
+        return stale
 
-class Game:
-    def __init__(self):
+    def mark_clean(self):
+        self._dirty.clear()
+        self._increments.clear()
+
+
+class Game(ChangeTracker):
+    tracked_fields = (
+        "players", "host", "timer", "dices", "coin", "book", "current_bid", "current_ask",
+        "bid_player", "ask_player", "hit_player", "lift_player",
+        "market_active", "round_active", "fair_value",
+    )
+    counter_fields = ("player_count", "current_round")
+
+    def __init__(self, book_engine=None):
         self.player_count = 0
         self.current_round = 1
         self.timer = 0
@@ -12,6 +73,8 @@ class Game:
         self.coin = None
         self.high_low = None
         self.players = []
+        self.players_by_name = {}  # case-folded name -> Player, kept in sync by player_join/player_leave
+        self.book = new_book(book_engine)  # resting quotes, current_bid/current_ask mirror its top
         self.current_bid = 0
         self.current_ask = 21
         self.bid_player = None
@@ -22,6 +85,18 @@ class Game:
         self.round_active = False
         self.fair_value = 0
         self.host = None
+        self.persisted = False  # False until a full snapshot of this game is in the database
+        self.version = 0  # version of the stored room document this state builds on
+        self.start_tracking()
+
+    def mark_clean(self):
+        """
+        Called once the current state has been written, resets change tracking on the game and its players.
+        """
+        super().mark_clean()
+        for player in self.players:
+            player.mark_clean()
+        self.persisted = True
 
     def set_host(self, host):
         self.host = host
@@ -31,11 +106,31 @@ class Game:
     
     def player_join(self, player):
         self.players.append(player)
+        self.players_by_name.setdefault(player.name.casefold(), player)
+        self.touch("players")
         self.player_count += 1
     
     def player_leave(self, player):
         self.players.remove(player)
+        if self.book.cancel_player(player.name):
+            self.sync_quotes()
+        key = player.name.casefold()
+        if self.players_by_name.get(key) is player:
+            del self.players_by_name[key]
+            # Only possible for rooms that already held two names differing in case
+            other = next((p for p in self.players if p.name.casefold() == key), None)
+            if other is not None:
+                self.players_by_name[key] = other
+        self.touch("players")
         self.player_count -= 1
+
+    def find_player(self, player_name):
+        """
+        Case-insensitive player lookup, returns None if nobody in the game has that name.
+        """
+        if not player_name:
+            return None
+        return self.players_by_name.get(player_name.casefold())
     
     def start_game(self):
         #start the game
@@ -75,8 +170,8 @@ class Game:
     
     def start_round(self):
         
-        self.current_bid = 0
-        self.current_ask = 21
+        self.book.clear()
+        self.sync_quotes()
         
         
         for player in self.players:
@@ -151,58 +246,72 @@ class Game:
         self.round_active = False
         self.start_game()
     
-    def end_round(self):
+    def settle_player(self, player):
+        """
+        Per-trade settlement of one player's round, returns their round P/L. Used when NumPy isn't available.
+        """
+        total_pl = 0
+        print(f"\nProcessing player: {player.name}")
+
+        # Handle Contract Fulfillment
+        if player.contract and player.contract.type_of_action in ["long", "short"]:
+            action_type = player.contract.type_of_action
+            required_trades = player.contract.number
+            print(f"{player.name} has a {action_type.upper()} contract requiring {required_trades} trades.")
+
+            if action_type == "long":
+                if player.buy_count >= required_trades:
+                    print(f"{player.name} fulfilled their LONG contract requirement! ✅")
+                else:
+                    print(f"{player.name} did NOT fulfill their LONG contract requirement. ❌ Cumulative P/L decreased by $100.")
+                    total_pl -= 100
+
+            elif action_type == "short":
+                if player.sell_count >= required_trades:
+                    print(f"{player.name} fulfilled their SHORT contract requirement! ✅")
+                else:
+                    print(f"{player.name} did NOT fulfill their SHORT contract requirement. ❌ Cumulative P/L decreased by $100.")
+                    total_pl -= 100
+
+        # Calculate Profit/Loss based on Actions
+        for action_entry in player.record:
+            # Each action_entry is expected to be a list: [action, price]
+            if not isinstance(action_entry, list) or len(action_entry) != 2:
+                print(f"Invalid action entry for player {player.name}: {action_entry}")
+                continue
+
+            action, price = action_entry
+            action = action.lower()
+
+            if action == "long":
+                pl = self.fair_value - price
+                print(f"Player {player.name} LONG at ${price}: P/L = ${self.fair_value} - ${price} = ${pl}")
+            elif action == "short":
+                pl = price - self.fair_value
+                print(f"Player {player.name} SHORT at ${price}: P/L = ${price} - ${self.fair_value} = ${pl}")
+            else:
+                continue
+
+            total_pl += pl
+
+        return total_pl
+
+    def end_round(self, now=None, round_pnls=None):
         """
         Ends the current round, compares contracts, applies penalties, calculates P/L, and resets necessary variables.
+        now overrides the new round's start time (used when replaying a journaled round end).
+        round_pnls can carry P/L already settled in a batch with other rooms (see settlement.round_pnls).
         """
         print("\nYour 5 minutes are up! Ending the current round.")
         print(f"Fair Value for this round: ${self.fair_value}")
 
-        for player in self.players:
-            total_pl = 0
-            print(f"\nProcessing player: {player.name}")
-
-            # Handle Contract Fulfillment
-            if player.contract and player.contract.type_of_action in ["long", "short"]:
-                action_type = player.contract.type_of_action
-                required_trades = player.contract.number
-                print(f"{player.name} has a {action_type.upper()} contract requiring {required_trades} trades.")
-
-                if action_type == "long":
-                    if player.buy_count >= required_trades:
-                        print(f"{player.name} fulfilled their LONG contract requirement! ✅")
-                    else:
-                        print(f"{player.name} did NOT fulfill their LONG contract requirement. ❌ Cumulative P/L decreased by $100.")
-                        total_pl -= 100
-
-                elif action_type == "short":
-                    if player.sell_count >= required_trades:
-                        print(f"{player.name} fulfilled their SHORT contract requirement! ✅")
-                    else:
-                        print(f"{player.name} did NOT fulfill their SHORT contract requirement. ❌ Cumulative P/L decreased by $100.")
-                        total_pl -= 100
-
-            # Calculate Profit/Loss based on Actions
-            for action_entry in player.record:
-                # Each action_entry is expected to be a list: [action, price]
-                if not isinstance(action_entry, list) or len(action_entry) != 2:
-                    print(f"Invalid action entry for player {player.name}: {action_entry}")
-                    continue
-
-                action, price = action_entry
-                action = action.lower()
-
-                if action == "long":
-                    pl = self.fair_value - price
-                    print(f"Player {player.name} LONG at ${price}: P/L = ${self.fair_value} - ${price} = ${pl}")
-                elif action == "short":
-                    pl = price - self.fair_value
-                    print(f"Player {player.name} SHORT at ${price}: P/L = ${price} - ${self.fair_value} = ${pl}")
-                else:
-                    continue
-
-                total_pl += pl
+        if round_pnls is None:
+            if settlement.available():
+                round_pnls = settlement.round_pnls([self])[0]
+            else:
+                round_pnls = [self.settle_player(player) for player in self.players]
 
+        for player, total_pl in zip(self.players, round_pnls):
             # Update Player's cumulative_pnl
             player.cumulative_pnl += total_pl
             player.round_pnl = total_pl
@@ -216,21 +325,37 @@ class Game:
 
         # Reset Market Variables for Next Round
         self.current_round += 1
-        self.current_bid = 0
-        self.current_ask = 21
-        self.bid_player = None
-        self.ask_player = None
+        self.book.clear()
+        self.sync_quotes()
         self.hit_player = None
         self.lift_player = None
-        self.timer = time.time()  # Reset the timer for the next round
+        self.timer = now if now is not None else time.time()  # Reset the timer for the next round
         self.round_active = False  # Stop the current round
 
         print("\n--- Round Ended Successfully ---\n")
 
 
-    def make_the_market(self, player_name, action, number):
+    def sync_quotes(self):
+        """
+        Mirrors the top of the order book into current_bid/current_ask and bid_player/ask_player.
+        """
+        best_bid = self.book.best_bid()
+        best_ask = self.book.best_ask()
+        self.current_bid = best_bid.price if best_bid else 0
+        self.bid_player = self.find_player(best_bid.player_name) if best_bid else None
+        self.current_ask = best_ask.price if best_ask else 21
+        self.ask_player = self.find_player(best_ask.player_name) if best_ask else None
+        self.touch("book")
+
+    def market_depth(self, levels=5):
+        """
+        Top levels of both sides of the book as [price, total size, order count].
+        """
+        return {"bids": self.book.depth("bid", levels), "asks": self.book.depth("ask", levels)}
+
+    def make_the_market(self, player_name, action, number, size=1):
         # Step 1: Check if the player is in the player names array
-        player = next((player for player in self.players if player.name.lower() == player_name.lower()), None)
+        player = self.find_player(player_name)
 
         if player is None:
             return {"success": False, "message": "Player not found"}
@@ -240,31 +365,54 @@ class Game:
             return {"success": False, "message": "Invalid action"}
 
         # Step 3: Check if the number is valid
-        if not isinstance(number, int) or not (1 <= number <= 20):
+        if not isinstance(number, int) or isinstance(number, bool) or not (1 <= number <= 20):
             return {"success": False, "message": "Invalid number"}
 
+        if not isinstance(size, int) or isinstance(size, bool) or not (1 <= size <= MAX_SIZE):
+            return {"success": False, "message": "Invalid size"}
+
+        # New quotes still have to improve the top of the book, the quotes they
+        # beat stay in the book underneath instead of being dropped.
+        # Placing a quote replaces the player's own previous quote on that side.
         log_message = ""
         if action == "bid":
             if number <= self.current_bid:
                 return {"success": False, "message": "Bid must be greater than the current bid"}
-            self.current_bid = number
-            self.bid_player = player
+            # Recorded first: the book can't reject a validated quote, the record could
             player.record.append(["bid", number])
+            self.book.place(player.name, "bid", number, size)
             log_message = f"{player_name} has placed a bid for ${number}"
         elif action == "ask":
             if number >= self.current_ask:
                 return {"success": False, "message": "Ask must be less than the current ask"}
-            self.current_ask = number
-            self.ask_player = player
             player.record.append(["ask", number])
+            self.book.place(player.name, "ask", number, size)
             log_message = f"{player_name} has placed an ask for ${number}"
 
+        self.sync_quotes()
         return {"success": True, "message": log_message}
 
+    def cancel_the_market(self, player_name, action):
+        """
+        Pulls a player's resting bid or ask from the book.
+        """
+        player = self.find_player(player_name)
+        if player is None:
+            return {"success": False, "message": "Player not found"}
+
+        if action not in ["bid", "ask"]:
+            return {"success": False, "message": "Invalid action"}
+
+        if not self.book.cancel_player(player.name, action):
+            return {"success": False, "message": f"You have no {action} to cancel."}
+
+        self.sync_quotes()
+        return {"success": True, "message": f"{player_name} has cancelled their {action}"}
+
 
         
     def take_the_market(self, player_name, action):
-        player = next((p for p in self.players if p.name.lower() == player_name.lower()), None)
+        player = self.find_player(player_name)
         if not player:
             return {"success": False, "message": "Player not found."}
 
@@ -274,20 +422,21 @@ class Game:
             if not self.bid_player:
                 return {"success": False, "message": "Bid player not found."}
             # Disallow self-hit
-            if player_name.lower() == self.bid_player.name.lower():
+            if player is self.bid_player:
                 return {"success": False, "message": "You cannot hit your own bid."}
 
-            # Execute trade for hit
+            # Execute trade for hit against the best bid, one unit per trade
+            price = self.current_bid
+            self.book.fill("bid")
             self.hit_player = player
             self.hit_player.sell_count += 1
             self.bid_player.buy_count += 1
-            self.hit_player.record.append(["short", self.current_bid])
-            self.bid_player.record.append(["long", self.current_bid])
+            self.hit_player.record.append(["short", price])
+            self.bid_player.record.append(["long", price])
 
-            message = f"{player_name} has hit the bid! Sold to {self.bid_player.name} for ${self.current_bid}."
-            self.current_bid = 0
-            self.bid_player = None
+            message = f"{player_name} has hit the bid! Sold to {self.bid_player.name} for ${price}."
             self.hit_player = None
+            self.sync_quotes()  # next best bid, if any, becomes the current bid
 
             return {"success": True, "message": message}
 
@@ -297,25 +446,45 @@ class Game:
             if not self.ask_player:
                 return {"success": False, "message": "Ask player not found."}
             # Disallow self-lift
-            if player_name.lower() == self.ask_player.name.lower():
+            if player is self.ask_player:
                 return {"success": False, "message": "You cannot lift your own ask."}
 
-            # Execute trade for lift
+            # Execute trade for lift against the best ask, one unit per trade
+            price = self.current_ask
+            self.book.fill("ask")
             self.lift_player = player
             self.lift_player.buy_count += 1
             self.ask_player.sell_count += 1
-            self.lift_player.record.append(["long", self.current_ask])
-            self.ask_player.record.append(["short", self.current_ask])
+            self.lift_player.record.append(["long", price])
+            self.ask_player.record.append(["short", price])
 
-            message = f"{player_name} has lifted the ask! Bought from {self.ask_player.name} for ${self.current_ask}."
-            self.current_ask = 21
-            self.ask_player = None
+            message = f"{player_name} has lifted the ask! Bought from {self.ask_player.name} for ${price}."
             self.lift_player = None
+            self.sync_quotes()  # next best ask, if any, becomes the current ask
 
             return {"success": True, "message": message}
 
         return {"success": False, "message": "Invalid action. Use 'hit' or 'lift'."}
 
+    def place_ask(self, player_name, value):
+        """
+        Direct ask placement used by the place_ask socket event.
+        """
+        if not isinstance(value, int) or isinstance(value, bool) or not (1 <= value <= 20):
+            return {"success": False, "message": "Invalid number."}
+
+        if value >= self.current_ask:
+            return {"success": False, "message": "Ask must be less than the current ask."}
+
+        player = self.find_player(player_name)
+        if player is None:
+            return {"success": False, "message": "Player not found."}
+
+        player.record.append(['ask', value])
+        self.book.place(player.name, "ask", value)
+        self.sync_quotes()
+        return {"success": True, "message": f"{player_name} has placed an ask for ${value}."}
+
 
 
 
@@ -354,7 +523,7 @@ class Game:
         Returns the buy_count of a player given their name.
         """
         # Search for the player by name
-        player = next((p for p in self.players if p.name.lower() == player_name.lower()), None)
+        player = self.find_player(player_name)
         
         if player:
             return player.buy_count
@@ -365,8 +534,7 @@ class Game:
     #add player function
     def add_player(self, name):
         new_player = Player(name)
-        self.players.append(new_player)
-        self.player_count += 1
+        self.player_join(new_player)
         print(f"Player {name} has joined the game.")
     
     #so mongoDB can add a new player
@@ -374,6 +542,8 @@ class Game:
         return { "players": [player.to_dict() for player in self.players] }
 
 class Coin:
+    __slots__ = ("value",)
+
     def __init__(self):
         self.value = None
 
@@ -387,6 +557,8 @@ class Coin:
 
 
 class Dice:
+    __slots__ = ("value",)
+
     def __init__(self):
         self.value = None
 
@@ -398,7 +570,15 @@ class Dice:
         return self.value
 
 
-class Player:
+class Player(ChangeTracker):
+    __slots__ = (
+        "name", "high_low", "price", "contract", "buy_count", "sell_count", "_record",
+        "cumulative_pnl", "round_pnl", "status", "last_active", "record_flushed",
+        "_dirty", "_increments", "_stale", "_serialized",
+    )
+    tracked_fields = ("status", "last_active", "high_low", "contract", "record", "round_pnl")
+    counter_fields = ("buy_count", "sell_count", "cumulative_pnl")
+
     def __init__(self, name, status="active", last_active=None):
         self.name = name
         self.high_low = None
@@ -406,11 +586,38 @@ class Player:
         self.contract = None
         self.buy_count = 0
         self.sell_count = 0
-        self.record = [] #list of action objects
+        self.record = [] #list of [action, price] entries, stored as a TradeRecord
         self.cumulative_pnl = 0
         self.round_pnl = 0
         self.status = None
         self.last_active = last_active or datetime.datetime.now()
+        self.record_flushed = 0  # number of record entries already in the database
+        self.start_tracking()
+
+    def mark_clean(self):
+        super().mark_clean()
+        self.record_flushed = self.record_length()
+
+    @property
+    def record(self):
+        record = self._record
+        if record.__class__ is list:
+            record = self._record = TradeRecord(record)
+        return record
+
+    @record.setter
+    def record(self, entries):
+        self._record = entries if isinstance(entries, TradeRecord) else TradeRecord(entries)
+
+    def load_record(self, entries):
+        """
+        Keeps a stored record as its raw list of [action, price] entries, it is
+        only turned into a TradeRecord once something reads player.record.
+        """
+        self._record = entries
+
+    def record_length(self):
+        return len(self._record)
         
     def get_name(self):
         return self.name
@@ -432,6 +639,8 @@ class Player:
         }
 
 class Action:
+    __slots__ = ("type_of_action", "number")
+
     def __init__(self, type_of_action, number):
         #long, short
         self.type_of_action = type_of_action #long, short
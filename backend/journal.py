@@ -0,0 +1,257 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+from serialization import serialize_game, deserialize_game
+
+
+class Journal:
+    """
+    Append-only journal of every market and round event per room.
+
+    Each room gets a directory with JSON-lines segment files, named after the
+    sequence number of their first event, and one snapshot of its latest full
+    game state. A room is rebuilt by loading the snapshot and replaying the
+    events recorded after it, which gives crash recovery for whatever the
+    write-behind stage had not flushed yet. Segments are pruned once a
+    snapshot covers them.
+
+    Events and snapshots are serialized when they are recorded but written by
+    a background loop every interval, so rooms don't wait on the disk.
+    """
+
+    # Events that can be re-applied to a Game, everything else (random dice,
+    # contracts, membership changes) is journaled together with a snapshot
+    REPLAYABLE = {
+        "make_market": lambda game, event: game.make_the_market(event["player"], event["action"], event["number"], event.get("size", 1)),
+        "cancel_market": lambda game, event: game.cancel_the_market(event["player"], event["action"]),
+        "take_market": lambda game, event: game.take_the_market(event["player"], event["action"]),
+        "place_ask": lambda game, event: game.place_ask(event["player"], event["value"]),
+        "end_round": lambda game, event: game.end_round(now=event.get("timer")),
+    }
+
+    def __init__(self, directory="journal", segment_size=1 << 20, snapshot_every=200, interval=0.05, offload=None):
+        self.directory = directory
+        self.segment_size = segment_size  # roll over to a new segment file after this many bytes
+        self.snapshot_every = snapshot_every  # events between two periodic snapshots
+        self.interval = interval
+        # offload(fn, *args) runs the file writes, e.g. off the event loop
+        self.offload = offload or (lambda fn, *args: fn(*args))
+        self.sequences = {}  # room_id -> last recorded sequence number
+        self.snapshot_seqs = {}  # room_id -> sequence number of the latest snapshot
+        self.current_segments = {}  # room_id -> [path, size] of the segment file appended to
+        self.lines = {}  # segment path -> event lines not written yet
+        self.snapshots = {}  # room_id -> (seq, JSON) of the latest snapshot not written yet
+        self._lock = threading.Lock()
+        # Held while writing, so the files are changed in the order things were recorded
+        self._write_lock = threading.Lock()
+
+    def room_dir(self, room_id):
+        return os.path.join(self.directory, room_id)
+
+    def segments(self, room_id):
+        room_dir = self.room_dir(room_id)
+        if not os.path.isdir(room_dir):
+            return []
+        names = sorted(name for name in os.listdir(room_dir) if name.endswith(".log"))
+        return [os.path.join(room_dir, name) for name in names]
+
+    @staticmethod
+    def first_seq(path):
+        return int(os.path.basename(path)[:-len(".log")])
+
+    @staticmethod
+    def read_segment(path):
+        events = []
+        with open(path) as f:
+            for line in f:
+                # A torn last line from a crash mid-write is ignored
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+        return events
+
+    def read_events(self, room_id, after=0):
+        segments = self.segments(room_id)
+        events = []
+        for index, path in enumerate(segments):
+            # A segment ends where the next one starts, those up to after are skipped unread
+            if index + 1 < len(segments) and self.first_seq(segments[index + 1]) <= after + 1:
+                continue
+            events.extend(event for event in self.read_segment(path) if event["seq"] > after)
+        return events
+
+    def read_snapshot(self, room_id):
+        path = os.path.join(self.room_dir(room_id), "snapshot.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def last_seq(self, room_id):
+        seq = self.sequences.get(room_id)
+        if seq is None:
+            # First touch of this room since startup, pick up where the files end
+            segments = self.segments(room_id)
+            events = self.read_segment(segments[-1]) if segments else []
+            snapshot = self.read_snapshot(room_id)
+            snapshot_seq = snapshot["seq"] if snapshot else 0
+            seq = max([snapshot_seq] + [event["seq"] for event in events])
+            self.sequences[room_id] = seq
+            self.snapshot_seqs[room_id] = snapshot_seq
+            if segments:
+                self.current_segments[room_id] = [segments[-1], os.path.getsize(segments[-1])]
+        return seq
+
+    def append(self, room_id, event_type, **data):
+        """
+        Appends one event for a room and returns its sequence number.
+        """
+        with self._lock:
+            seq = self.last_seq(room_id) + 1
+            self.sequences[room_id] = seq
+
+            event = {"seq": seq, "ts": time.time(), "type": event_type}
+            event.update(data)
+            line = json.dumps(event) + "\n"
+
+            segment = self.current_segments.get(room_id)
+            if segment is None or segment[1] >= self.segment_size:
+                segment = self.current_segments[room_id] = [os.path.join(self.room_dir(room_id), f"{seq:012d}.log"), 0]
+            segment[1] += len(line)
+            self.lines.setdefault(segment[0], []).append(line)
+            return seq
+
+    def snapshot(self, room_id, game):
+        """
+        Stores the full game state as of the last appended event, along with
+        the stored version it builds on. The segments it covers are pruned.
+        """
+        with self._lock:
+            seq = self.last_seq(room_id)
+            self.snapshots[room_id] = (seq, json.dumps({"seq": seq, "version": game.version, "ts": time.time(), "game": serialize_game(game)}))
+            self.snapshot_seqs[room_id] = seq
+            # Later events go to a new segment, so everything before it can go
+            self.current_segments.pop(room_id, None)
+
+    def _take(self):
+        with self._lock:
+            lines, snapshots = self.lines, self.snapshots
+            self.lines, self.snapshots = {}, {}
+        return lines, snapshots
+
+    def _write(self, lines, snapshots):
+        # Snapshots first, so no event after a snapshot is on disk without it
+        for room_id, (seq, text) in snapshots.items():
+            os.makedirs(self.room_dir(room_id), exist_ok=True)
+            path = os.path.join(self.room_dir(room_id), "snapshot.json")
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+            for segment in self.segments(room_id):
+                if self.first_seq(segment) <= seq:
+                    os.remove(segment)
+        for path, chunk in lines.items():
+            room_id = os.path.basename(os.path.dirname(path))
+            if room_id in snapshots and self.first_seq(path) <= snapshots[room_id][0]:
+                continue  # covered by the snapshot just written
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a") as f:
+                f.write("".join(chunk))
+
+    def flush(self):
+        """
+        Writes out everything recorded so far.
+        """
+        with self._write_lock:
+            lines, snapshots = self._take()
+            if lines or snapshots:
+                self.offload(self._write, lines, snapshots)
+
+    def run(self, sleep=time.sleep):
+        """
+        Background loop, meant to be started with socketio.start_background_task.
+        """
+        while True:
+            sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Journal write failed: {e}")
+
+    def close(self):
+        # Clean shutdown, written in place since the loop that offloads to may be gone
+        with self._write_lock:
+            self._write(*self._take())
+
+    def record(self, room_id, game, event_type, snapshot=False, **data):
+        """
+        Journals an event that was just applied to game. Events that can't be
+        replayed are always followed by a snapshot, the rest periodically.
+        """
+        seq = self.append(room_id, event_type, version=game.version, **data)
+        if snapshot or event_type not in self.REPLAYABLE or seq - self.snapshot_seqs.get(room_id, 0) >= self.snapshot_every:
+            self.snapshot(room_id, game)
+        return seq
+
+    def recover(self, room_id, version=0):
+        """
+        Rebuilds a room from its latest snapshot plus the events after it, or
+        returns None if there is nothing journaled for it or the journal
+        builds on an older version than the stored one: the stored room has
+        everything it has, or another process wrote the room since.
+        """
+        self.flush()
+        snapshot = self.read_snapshot(room_id)
+        if snapshot is None:
+            return None
+
+        events = self.read_events(room_id, after=snapshot["seq"])
+        base = max([snapshot.get("version", 0)] + [event.get("version", 0) for event in events])
+        if base < version:
+            print(f"Journal of room {room_id} builds on version {base}, older than the stored {version}")
+            return None
+
+        game = deserialize_game(snapshot["game"])
+        replayed = 0
+        for event in events:
+            replay = self.REPLAYABLE.get(event["type"])
+            if replay is None:
+                # Its snapshot never made it to disk, the state after this point is unknown
+                print(f"Journal replay for room {room_id} stopped at unreplayable event {event['seq']}")
+                break
+            replay(game, event)
+            replayed += 1
+
+        print(f"Recovered room {room_id} from snapshot {snapshot['seq']} and {replayed} events")
+        return game
+
+    def forget(self, room_id):
+        # Drops what is kept in memory for a room, last_seq reads it from the files again
+        self.flush()
+        with self._lock:
+            self.sequences.pop(room_id, None)
+            self.snapshot_seqs.pop(room_id, None)
+            self.current_segments.pop(room_id, None)
+
+    def archive(self, room_id):
+        """
+        Moves a finished room's journal out of the way so it is kept for
+        auditing but never recovered again.
+        """
+        with self._write_lock:
+            lines, snapshots = self._take()
+            self.offload(self._write, lines, snapshots)
+            with self._lock:
+                self.sequences.pop(room_id, None)
+                self.snapshot_seqs.pop(room_id, None)
+                self.current_segments.pop(room_id, None)
+            room_dir = self.room_dir(room_id)
+            if os.path.isdir(room_dir):
+                archive_dir = os.path.join(self.directory, "archive")
+                os.makedirs(archive_dir, exist_ok=True)
+                shutil.move(room_dir, os.path.join(archive_dir, f"{room_id}-{int(time.time())}"))
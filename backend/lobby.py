@@ -0,0 +1,194 @@
+import hashlib
+import threading
+import time
+
+from bson.objectid import ObjectId
+
+# Room document fields that make up the lobby read model
+SUMMARY_PROJECTION = {
+    "_id": 1,
+    "name": 1,
+    "player_count": 1,
+    "usernames": 1,
+    "has_space": 1,
+    "maxPlayers": 1,
+    "isPrivate": 1,
+    "room_code": 1,
+}
+
+
+def room_summary(game, max_players=10):
+    """
+    Lobby fields stored at the top level of a room document next to the game,
+    so the lobby never has to read or deserialize game.players. Written on
+    create, join and leave without waiting for the write-behind flush.
+    """
+    usernames = [player.get_name() for player in game.players]
+    return {
+        "player_count": len(usernames),
+        "usernames": usernames,
+        "has_space": len(usernames) < max_players,
+    }
+
+
+def backfill_summaries(collection):
+    """
+    Adds the summary fields to rooms created before the lobby read model existed.
+    """
+    count = 0
+    for room in collection.find({"usernames": {"$exists": False}}, {"game.players.username": 1, "maxPlayers": 1}):
+        usernames = [player.get("username") for player in room.get("game", {}).get("players", [])]
+        collection.update_one({"_id": room["_id"]}, {"$set": {
+            "player_count": len(usernames),
+            "usernames": usernames,
+            "has_space": len(usernames) < room.get("maxPlayers", 10),
+        }})
+        count += 1
+    return count
+
+
+def format_room(room):
+    usernames = room.get("usernames", [])
+    return {
+        "_id": str(room["_id"]),
+        "name": room["name"],
+        "players": [{"username": username} for username in usernames],
+        "player_count": room.get("player_count", len(usernames)),
+        "maxPlayers": room.get('maxPlayers', 10),
+        "isPrivate": room.get('isPrivate', False),
+        "room_code": room.get('room_code')
+    }
+
+
+def list_rooms(collection, limit=None, cursor=None, public_only=False, has_space=False):
+    """
+    One page of lobby rooms in creation order, read with a projection of the
+    summary fields only. cursor is the id of the last room of the previous
+    page; returns (rooms, next cursor or None when this was the last page).
+    """
+    query = {}
+    if cursor:
+        query["_id"] = {"$gt": ObjectId(cursor)}
+    if public_only:
+        query["isPrivate"] = False
+    if has_space:
+        query["has_space"] = True
+
+    rooms = collection.find(query, SUMMARY_PROJECTION).sort("_id", 1)
+    if limit:
+        # One extra room tells whether there is a next page
+        rooms = rooms.limit(limit + 1)
+    rooms = [format_room(room) for room in rooms]
+
+    next_cursor = None
+    if limit and len(rooms) > limit:
+        rooms = rooms[:limit]
+        next_cursor = rooms[-1]["_id"]
+    return rooms, next_cursor
+
+
+def filter_rooms(rooms, limit=None, cursor=None, public_only=False, has_space=False):
+    """
+    Same paging and filters as list_rooms, applied to an already loaded list
+    of formatted rooms in creation order.
+    """
+    if cursor:
+        rooms = [room for room in rooms if room["_id"] > cursor]
+    if public_only:
+        rooms = [room for room in rooms if not room["isPrivate"]]
+    if has_space:
+        rooms = [room for room in rooms if room["player_count"] < room["maxPlayers"]]
+
+    next_cursor = None
+    if limit and len(rooms) > limit:
+        rooms = rooms[:limit]
+        next_cursor = rooms[-1]["_id"]
+    return rooms, next_cursor
+
+
+class LobbyCache:
+    """
+    In-process copy of the whole lobby listing.
+
+    GET /rooms is answered from memory; the list is reloaded from the database
+    once the TTL runs out or after a handler invalidated it because a room was
+    created, joined, left or ended. The version only moves when the listing
+    actually changed, so it doubles as the ETag and as the sequence number of
+    the lobby_update diffs pushed to subscribed sockets.
+    """
+
+    def __init__(self, store, ttl=5.0):
+        self.store = store
+        self.ttl = ttl
+        self.rooms = None  # formatted rooms in creation order
+        self.loaded_at = 0
+        self.stale = True
+        self.version = 0
+        self.pending = []  # diffs not pushed to subscribers yet
+        self.pushing = False  # only queue diffs while run is there to push them
+        self.epoch = format(int(time.time()), "x")  # keeps ETags from an earlier process from matching
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self.stale = True
+
+    def refresh(self):
+        """
+        Reloads the listing and queues the diff against the previous one as
+        {"version", "added", "updated", "removed"} for run to push, if this
+        process runs it.
+        """
+        rooms, _ = self.store.list_summaries()
+        with self._lock:
+            first_load = self.rooms is None
+            previous = {room["_id"]: room for room in self.rooms or []}
+            current = {room["_id"]: room for room in rooms}
+            diff = {
+                "added": [room for room in rooms if room["_id"] not in previous],
+                "updated": [room for room in rooms if room["_id"] in previous and previous[room["_id"]] != room],
+                "removed": [room_id for room_id in previous if room_id not in current],
+            }
+            self.rooms = rooms
+            self.loaded_at = time.monotonic()
+            self.stale = False
+            # Subscribers start from a full snapshot, so the first load has nothing to push
+            if first_load or not (diff["added"] or diff["updated"] or diff["removed"]):
+                return
+            self.version += 1
+            diff["version"] = self.version
+            if self.pushing:
+                self.pending.append(diff)
+
+    def get(self):
+        """
+        Returns (rooms, version), reloading first if the cache is stale or expired.
+        """
+        if self.stale or self.rooms is None or time.monotonic() - self.loaded_at >= self.ttl:
+            self.refresh()
+        return self.rooms, self.version
+
+    def etag(self, version, query=""):
+        # One tag per listing version and query string
+        digest = hashlib.sha1(query.encode()).hexdigest()[:8]
+        return f"{self.epoch}-{version}-{digest}"
+
+    def run(self, emit, interval=0.5, sleep=time.sleep):
+        """
+        Background loop that pushes lobby_update diffs to subscribers shortly
+        after an invalidation, batching everything that happened in between.
+        Also reloads once the TTL runs out, which is how changes made by other
+        workers reach this one's subscribers.
+        """
+        self.pushing = True
+        while True:
+            sleep(interval)
+            expired = time.monotonic() - self.loaded_at >= self.ttl
+            if (self.stale or expired) and self.rooms is not None:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Lobby refresh failed: {e}")
+            with self._lock:
+                pending, self.pending = self.pending, []
+            for diff in pending:
+                emit(diff)
@@ -0,0 +1,360 @@
+import heapq
+import os
+
+# make_the_market only accepts prices in this range
+MIN_PRICE = 1
+MAX_PRICE = 20
+# ... and sizes up to this, which keeps level totals well inside a 64-bit integer for the database
+MAX_SIZE = 1000
+
+
+class Order:
+    __slots__ = ("order_id", "player_name", "side", "price", "size")
+
+    def __init__(self, order_id, player_name, side, price, size):
+        self.order_id = order_id  # increasing, so it doubles as the time priority
+        self.player_name = player_name
+        self.side = side  # "bid" or "ask"
+        self.price = price
+        self.size = size
+
+    def to_list(self):
+        return [self.order_id, self.player_name, self.side, self.price, self.size]
+
+    @classmethod
+    def from_list(cls, data):
+        return cls(*data)
+
+
+class BaseOrderBook:
+    """
+    What every book engine shares: the public API Game uses, and saving and
+    restoring the book as lists of orders. Engines keep the orders however
+    they like and hand out Order objects.
+    """
+    engine = None
+
+    def best_bid(self):
+        return self.best("bid")
+
+    def best_ask(self):
+        return self.best("ask")
+
+    def to_dict(self):
+        return {
+            "engine": self.engine,
+            "bids": [order.to_list() for order in self.orders_for("bid")],
+            "asks": [order.to_list() for order in self.orders_for("ask")],
+            "next_id": self.next_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        book = cls()
+        # Orders are stored in priority order, so re-adding them keeps it
+        orders = data.get("bids", []) + data.get("asks", [])
+        for order_data in orders:
+            book._load(Order.from_list(order_data))
+        book.next_id = max([data.get("next_id", 1)] + [order_data[0] + 1 for order_data in orders])
+        return book
+
+
+class OrderBook(BaseOrderBook):
+    """
+    Multi-level limit order book with price-time priority.
+
+    Each side is a heap of (price key, order id) entries; cancelled or filled
+    orders are dropped lazily when they reach the top. Every player can have
+    one resting order per side, placing a new one replaces it.
+    """
+    engine = "heap"
+
+    def __init__(self):
+        self.orders = {}  # order_id -> live Order
+        self.resting = {}  # (case-folded player name, side) -> order_id
+        self.next_id = 1
+        self.bids = []  # heap of (-price, order_id)
+        self.asks = []  # heap of (price, order_id)
+
+    def place(self, player_name, side, price, size=1):
+        """
+        Rests a new order, replacing the player's previous order on that side.
+        """
+        self.cancel_player(player_name, side)
+
+        order = Order(self.next_id, player_name, side, price, size)
+        self.next_id += 1
+        self._load(order)
+        return order
+
+    def _load(self, order):
+        self.orders[order.order_id] = order
+        self.resting[(order.player_name.casefold(), order.side)] = order.order_id
+        heapq.heappush(self._heap(order.side), (-order.price if order.side == "bid" else order.price, order.order_id))
+
+    def cancel(self, order_id):
+        # Its heap entry stays behind, best() skips it once it reaches the top
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return None
+        key = (order.player_name.casefold(), order.side)
+        if self.resting.get(key) == order_id:
+            del self.resting[key]
+        return order
+
+    def cancel_player(self, player_name, side=None):
+        """
+        Cancels a player's resting order on one side, or on both if side is None.
+        """
+        cancelled = []
+        for order_side in ([side] if side else ["bid", "ask"]):
+            order_id = self.resting.get((player_name.casefold(), order_side))
+            if order_id is not None:
+                cancelled.append(self.cancel(order_id))
+        return cancelled
+
+    def replace(self, order_id, price=None, size=None):
+        """
+        Amends a resting order. Shrinking it keeps its time priority, a new
+        price or a bigger size sends it to the back of the queue.
+        """
+        order = self.orders.get(order_id)
+        if order is None:
+            return None
+        if (price is None or price == order.price) and (size is None or size <= order.size):
+            if size is not None:
+                order.size = size
+            return order
+        return self.place(order.player_name, order.side,
+                          order.price if price is None else price,
+                          order.size if size is None else size)
+
+    def player_order(self, player_name, side):
+        order_id = self.resting.get((player_name.casefold(), side))
+        return self.orders.get(order_id) if order_id is not None else None
+
+    def fill(self, side, size=1):
+        """
+        Fills up to size units against the top order of a side and returns
+        (order, filled size), or (None, 0) if that side is empty.
+        """
+        order = self.best(side)
+        if order is None:
+            return None, 0
+        filled = min(size, order.size)
+        order.size -= filled
+        if order.size == 0:
+            self.cancel(order.order_id)
+        return order, filled
+
+    def orders_for(self, side):
+        # Live orders of a side in priority order
+        key = (lambda order: (-order.price, order.order_id)) if side == "bid" else (lambda order: (order.price, order.order_id))
+        return sorted((order for order in self.orders.values() if order.side == side), key=key)
+
+    def _heap(self, side):
+        return self.bids if side == "bid" else self.asks
+
+    def best(self, side):
+        heap = self._heap(side)
+        while heap:
+            order = self.orders.get(heap[0][1])
+            if order is not None:
+                return order
+            heapq.heappop(heap)  # stale entry of a cancelled/filled order
+        return None
+
+    def depth(self, side, levels=5):
+        """
+        Top price levels of a side, best first, as [price, total size, order count].
+        """
+        totals = {}
+        for order in self.orders.values():
+            if order.side == side:
+                level = totals.setdefault(order.price, [order.price, 0, 0])
+                level[1] += order.size
+                level[2] += 1
+        return sorted(totals.values(), key=lambda level: -level[0] if side == "bid" else level[0])[:levels]
+
+    def clear(self):
+        self.bids = []
+        self.asks = []
+        self.orders = {}
+        self.resting = {}
+
+
+class BucketOrderBook(BaseOrderBook):
+    """
+    Order book specialised for the game's 1..20 price range.
+
+    Each side has a FIFO queue of orders per price and a bitmask of the
+    prices with resting orders: the best bid is the highest set bit, the best
+    ask the lowest one, and the order with time priority is the front of that
+    price's queue. Every player can have one resting order per side, so a
+    queue never holds more orders than there are players. The top of each
+    side is kept until that side changes.
+    """
+    engine = "bucket"
+
+    def __init__(self):
+        self.next_id = 1
+        self.clear()
+
+    def clear(self):
+        self.orders = {}  # order_id -> live Order
+        self.resting = {}  # (case-folded player name, side) -> live Order
+        self.levels = {"bid": [None] * (MAX_PRICE + 1), "ask": [None] * (MAX_PRICE + 1)}  # price -> queue, made on first use
+        self.masks = {"bid": 0, "ask": 0}  # bit n set <=> price n has resting orders
+        self.tops = {"bid": None, "ask": None}  # best order, None when it has to be looked up again
+
+    def place(self, player_name, side, price, size=1):
+        """
+        Rests a new order, replacing the player's previous order on that side.
+        """
+        order = Order(self.next_id, player_name, side, price, size)
+        self._load(order)
+        self.next_id += 1
+        return order
+
+    def _load(self, order):
+        side, price = order.side, order.price
+        if not MIN_PRICE <= price <= MAX_PRICE:
+            raise ValueError(f"Price {price} is outside {MIN_PRICE}..{MAX_PRICE}")
+        key = (order.player_name.casefold(), side)
+        previous = self.resting.get(key)
+        if previous is not None:
+            self._remove(previous)
+        self.orders[order.order_id] = order
+        self.resting[key] = order
+        levels = self.levels[side]
+        level = levels[price]
+        if level is None:
+            level = levels[price] = []
+        level.append(order)
+        self.masks[side] |= 1 << price
+        top = self.tops[side]
+        # Same price as the top means behind it in time
+        if top is not None and (price > top.price if side == "bid" else price < top.price):
+            self.tops[side] = order
+
+    def _remove(self, order):
+        side, price = order.side, order.price
+        del self.orders[order.order_id]
+        del self.resting[(order.player_name.casefold(), side)]
+        level = self.levels[side][price]
+        if level[0] is order:
+            del level[0]
+        else:
+            level.remove(order)
+        if not level:
+            self.masks[side] &= ~(1 << price)
+        if self.tops[side] is order:
+            self.tops[side] = None
+
+    def cancel(self, order_id):
+        order = self.orders.get(order_id)
+        if order is None:
+            return None
+        self._remove(order)
+        return order
+
+    def cancel_player(self, player_name, side=None):
+        """
+        Cancels a player's resting order on one side, or on both if side is None.
+        """
+        cancelled = []
+        for order_side in ([side] if side else ["bid", "ask"]):
+            order = self.resting.get((player_name.casefold(), order_side))
+            if order is not None:
+                self._remove(order)
+                cancelled.append(order)
+        return cancelled
+
+    def replace(self, order_id, price=None, size=None):
+        """
+        Amends a resting order. Shrinking it keeps its time priority, a new
+        price or a bigger size sends it to the back of the queue.
+        """
+        order = self.orders.get(order_id)
+        if order is None:
+            return None
+        if (price is None or price == order.price) and (size is None or size <= order.size):
+            if size is not None:
+                order.size = size
+            return order
+        return self.place(order.player_name, order.side,
+                          order.price if price is None else price,
+                          order.size if size is None else size)
+
+    def player_order(self, player_name, side):
+        return self.resting.get((player_name.casefold(), side))
+
+    @staticmethod
+    def _top(side, mask):
+        return mask.bit_length() - 1 if side == "bid" else (mask & -mask).bit_length() - 1
+
+    def best(self, side):
+        top = self.tops[side]
+        if top is None:
+            mask = self.masks[side]
+            if not mask:
+                return None
+            top = self.tops[side] = self.levels[side][self._top(side, mask)][0]
+        return top
+
+    def fill(self, side, size=1):
+        """
+        Fills up to size units against the top order of a side and returns
+        (order, filled size), or (None, 0) if that side is empty.
+        """
+        order = self.best(side)
+        if order is None:
+            return None, 0
+        filled = min(size, order.size)
+        order.size -= filled
+        if order.size == 0:
+            self._remove(order)
+        return order, filled
+
+    def orders_for(self, side):
+        # Live orders of a side in priority order
+        orders = []
+        mask = self.masks[side]
+        while mask:
+            price = self._top(side, mask)
+            mask &= ~(1 << price)
+            orders.extend(self.levels[side][price])
+        return orders
+
+    def depth(self, side, levels=5):
+        """
+        Top price levels of a side, best first, as [price, total size, order count].
+        """
+        result = []
+        mask = self.masks[side]
+        while mask and len(result) < levels:
+            price = self._top(side, mask)
+            mask &= ~(1 << price)
+            level = self.levels[side][price]
+            result.append([price, sum(order.size for order in level), len(level)])
+        return result
+
+
+ENGINES = {
+    OrderBook.engine: OrderBook,
+    BucketOrderBook.engine: BucketOrderBook,
+}
+
+# Engine used for new games, ORDER_BOOK_ENGINE=bucket switches to the price-bucket book
+DEFAULT_ENGINE = os.environ.get("ORDER_BOOK_ENGINE", "heap")
+
+
+def new_book(engine=None):
+    return ENGINES[engine or DEFAULT_ENGINE]()
+
+
+def book_from_dict(data):
+    # Books saved before engines existed were heap books
+    engine = (data or {}).get("engine") or OrderBook.engine
+    return ENGINES[engine].from_dict(data)
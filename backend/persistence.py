@@ -0,0 +1,182 @@
+import threading
+import time
+import uuid
+
+from serialization import build_update
+
+
+class WriteBehind:
+    """
+    Write-behind stage between the game registry and the room store.
+
+    Handlers only mark a room as dirty. A background loop builds one update per
+    dirty room from its tracked changes and writes them all with one
+    patch_many (a single bulk_write on MongoDB), so any number of mutations to the same room between two
+    flushes become a single write of its newest state. A room that can't be
+    built, encoded or written fails on its own and is retried at the next
+    flush, the rest of the batch is written regardless.
+
+    Writes are conditional on the version the game was loaded at. When the
+    stored room moved on in the meantime, on_conflict(room_id, commands) gets
+    the commands that were in the rejected write so they can be re-applied on
+    top of the stored state.
+
+    A batch that fails can still have landed, e.g. on a network timeout. Its
+    rooms are held back until landed tells whether the write went through:
+    if it did the game stays at the new version, if it didn't the version is
+    rolled back and the room is written again with a full snapshot.
+    """
+
+    def __init__(self, store, registry, interval=0.5, max_dirty=50, tick=0.05, on_conflict=None):
+        self.store = store
+        self.registry = registry
+        self.on_conflict = on_conflict
+        self.interval = interval  # seconds between timed flushes
+        self.max_dirty = max_dirty  # flush early once this many rooms are dirty
+        self.tick = tick
+        self.dirty = set()
+        self.unconfirmed = {}  # room_id -> (write id, commands) of a failed write that may have landed
+        self.running = False
+        self.last_flush = time.time()
+        self._lock = threading.Lock()
+
+    def mark_dirty(self, room_id):
+        with self._lock:
+            self.dirty.add(room_id)
+
+    def discard(self, room_id):
+        # Room was deleted, drop any pending write for it
+        with self._lock:
+            self.dirty.discard(room_id)
+            self.unconfirmed.pop(room_id, None)
+
+    def is_written(self, room_id):
+        # Nothing of this room waits for a write or for its outcome
+        with self._lock:
+            return room_id not in self.dirty and room_id not in self.unconfirmed
+
+    def _confirm(self):
+        """
+        Settles the failed writes whose outcome isn't known yet, returns the
+        ids of the rooms that are still unknown (the store can't be reached).
+        """
+        with self._lock:
+            unconfirmed = dict(self.unconfirmed)
+        by_write = {}
+        for room_id, (write, _) in unconfirmed.items():
+            by_write.setdefault(write, []).append(room_id)
+
+        unknown = set()
+        for write, room_ids in by_write.items():
+            try:
+                landed = set(self.store.landed(room_ids, write))
+            except Exception as e:
+                print(f"Could not check write {write} for {len(room_ids)} rooms: {e}")
+                unknown.update(room_ids)
+                continue
+            for room_id in room_ids:
+                _, commands = unconfirmed[room_id]
+                with self._lock:
+                    self.unconfirmed.pop(room_id, None)
+                if room_id not in landed:
+                    self._rewrite(room_id, commands)
+        return unknown
+
+    def _rewrite(self, room_id, commands):
+        # The write didn't land, so write a full snapshot of the version the game had
+        game = self.registry.games.get(room_id)
+        if game is None:
+            return
+        with self.registry.lock(room_id):
+            game.persisted = False
+            game.version -= 1
+            self.registry.restore_commands(room_id, commands)
+        self.mark_dirty(room_id)
+
+    def flush(self, room_ids=None):
+        """
+        Writes the pending changes of every dirty room (or only of room_ids).
+        Returns the number of rooms written.
+        """
+        with self._lock:
+            if room_ids is None:
+                pending, self.dirty = self.dirty, set()
+            else:
+                pending = self.dirty.intersection(room_ids)
+                self.dirty.difference_update(pending)
+            self.last_flush = time.time()
+
+        if self.unconfirmed:
+            unknown = self._confirm()
+            with self._lock:
+                self.dirty.update(pending.intersection(unknown))
+            pending.difference_update(unknown)
+
+        updates = []
+        flushed = {}  # room_id -> (game, commands in this write)
+        for room_id in pending:
+            game = self.registry.games.get(room_id)
+            if game is None:
+                continue
+            with self.registry.lock(room_id):
+                try:
+                    update = build_update(game)
+                except Exception as e:
+                    # Only this room waits for the next flush, the rest of the batch is written
+                    print(f"Could not build the update of room {room_id}: {e}")
+                    self.mark_dirty(room_id)
+                    continue
+                game.mark_clean()
+                commands = self.registry.take_commands(room_id)
+                if update is None:
+                    continue
+                # Counted as written right away, so a second flush of this room builds on it
+                updates.append((room_id, update, game.version))
+                game.version += 1
+            flushed[room_id] = (game, commands)
+
+        if not updates:
+            return 0
+
+        write = uuid.uuid4().hex
+        try:
+            conflicts, failed = self.store.patch_many(updates, write)
+        except Exception as e:
+            # Some of the writes may have landed anyway, the next flush checks before retrying
+            print(f"Write-behind flush failed for {len(flushed)} rooms: {e}")
+            with self._lock:
+                for room_id, (_, commands) in flushed.items():
+                    self.unconfirmed[room_id] = (write, commands)
+                self.dirty.update(flushed)
+            return 0
+
+        for room_id, error in failed.items():
+            print(f"Write-behind failed for room {room_id}: {error}")
+            _, commands = flushed.pop(room_id)
+            self._rewrite(room_id, commands)
+
+        for room_id in conflicts:
+            print(f"Version conflict writing room {room_id}")
+            game, commands = flushed.pop(room_id)
+            if self.on_conflict is not None:
+                self.on_conflict(room_id, commands)
+
+        return len(flushed)
+
+    def due(self):
+        return len(self.dirty) >= self.max_dirty or time.time() - self.last_flush >= self.interval
+
+    def run(self, sleep=time.sleep):
+        """
+        Background loop, meant to be started with socketio.start_background_task.
+        """
+        self.running = True
+        while self.running:
+            sleep(self.tick)
+            if self.dirty and self.due():
+                self.flush()
+
+    def close(self):
+        # Clean shutdown, stop the loop and write out everything still pending
+        self.running = False
+        self.flush()
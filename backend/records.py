@@ -0,0 +1,54 @@
+from array import array
+
+
+# Action tags stored in a player's record, as one-byte codes
+ACTION_CODES = {"dice_roll": 1, "bid": 2, "ask": 3, "long": 4, "short": 5}
+ACTION_NAMES = {code: name for name, code in ACTION_CODES.items()}
+
+
+class TradeRecord:
+    """
+    A player's record stored as two parallel arrays (action code bytes and
+    prices) instead of a list of ["long", 7] lists. Behaves like the old list
+    for callers: append, len, indexing, slicing and iteration all use
+    [action, price] entries.
+    """
+    __slots__ = ("codes", "prices")
+
+    def __init__(self, entries=()):
+        self.codes = array("b")
+        self.prices = array("i")
+        for entry in entries:
+            self.append(entry)
+
+    def append(self, entry):
+        action, price = entry
+        self.codes.append(ACTION_CODES[action])
+        self.prices.append(price)
+
+    def clear(self):
+        del self.codes[:]
+        del self.prices[:]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        for code, price in zip(self.codes, self.prices):
+            yield [ACTION_NAMES[code], price]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [[ACTION_NAMES[code], price] for code, price in zip(self.codes[index], self.prices[index])]
+        return [ACTION_NAMES[self.codes[index]], self.prices[index]]
+
+    def __eq__(self, other):
+        if isinstance(other, TradeRecord):
+            return self.codes == other.codes and self.prices == other.prices
+        return self.to_list() == other
+
+    def to_list(self):
+        return list(self)
+
+    def __repr__(self):
+        return f"TradeRecord({self.to_list()!r})"
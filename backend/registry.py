@@ -0,0 +1,131 @@
+import threading
+import time
+
+
+class GameRegistry:
+    """
+    Process-local registry of live Game objects keyed by room id.
+
+    While a room is active the Game held here is the source of truth; the
+    database is only read when a room is not resident yet (e.g. after a
+    restart) and is otherwise only written to for durability. Rooms nobody
+    used for a while are dropped again by evict_idle once they are written.
+    """
+
+    def __init__(self, loader, bulk_loader=None):
+        # loader(room_id) -> Game or None, used on a registry miss
+        self.loader = loader
+        # bulk_loader(room_ids) -> {room_id: Game}, used by get_many to load all misses in one query
+        self.bulk_loader = bulk_loader
+        self.games = {}
+        self.locks = {}
+        # room_id -> commands applied since the last successful write, re-run on a version conflict
+        self.commands = {}
+        self.used = {}  # room_id -> time.monotonic() of the last get or put
+        self._lock = threading.Lock()
+
+    def get(self, room_id):
+        """
+        Returns the live game for a room, loading it once on a miss.
+        """
+        game = self.games.get(room_id)
+        if game is not None:
+            self.used[room_id] = time.monotonic()
+            return game
+
+        game = self.loader(room_id)
+        if game is None:
+            return None
+
+        # Another request may have loaded the room meanwhile, keep the first copy
+        with self._lock:
+            self.used[room_id] = time.monotonic()
+            return self.games.setdefault(room_id, game)
+
+    def get_many(self, room_ids):
+        """
+        Returns {room_id: Game} for the rooms that exist, loading every miss at once.
+        """
+        found = {room_id: self.games[room_id] for room_id in room_ids if room_id in self.games}
+        now = time.monotonic()
+        for room_id in found:
+            self.used[room_id] = now
+        missing = [room_id for room_id in room_ids if room_id not in found]
+        if not missing:
+            return found
+
+        if self.bulk_loader is not None:
+            loaded = self.bulk_loader(missing)
+        else:
+            loaded = {room_id: self.loader(room_id) for room_id in missing}
+
+        with self._lock:
+            for room_id, game in loaded.items():
+                if game is not None:
+                    found[room_id] = self.games.setdefault(room_id, game)
+                    self.used[room_id] = now
+        return found
+
+    def put(self, room_id, game):
+        with self._lock:
+            self.games[room_id] = game
+            self.used[room_id] = time.monotonic()
+
+    def discard(self, room_id):
+        with self._lock:
+            self.games.pop(room_id, None)
+            self.locks.pop(room_id, None)
+            self.commands.pop(room_id, None)
+            self.used.pop(room_id, None)
+
+    def record_command(self, room_id, command):
+        with self._lock:
+            self.commands.setdefault(room_id, []).append(command)
+
+    def take_commands(self, room_id):
+        with self._lock:
+            return self.commands.pop(room_id, [])
+
+    def restore_commands(self, room_id, commands):
+        # Puts back commands taken for a write that didn't land, ahead of newer ones
+        if commands:
+            with self._lock:
+                self.commands[room_id] = commands + self.commands.get(room_id, [])
+
+    def evict_idle(self, timeout, is_written):
+        """
+        Drops the rooms nobody used for timeout seconds whose changes are all
+        written (is_written(room_id) and no commands kept for a retry), so an
+        abandoned room doesn't stay in memory for the life of the process.
+        Returns the ids of the dropped rooms; they are loaded again on their
+        next use.
+        """
+        evicted = []
+        for room_id, used in list(self.used.items()):
+            if time.monotonic() - used < timeout:
+                continue
+            with self.lock(room_id):
+                # Handlers take the room lock too, so nothing changes this room while we decide
+                if time.monotonic() - self.used.get(room_id, 0) < timeout or self.commands.get(room_id):
+                    continue
+                if not is_written(room_id):
+                    continue
+                self.discard(room_id)
+            evicted.append(room_id)
+        return evicted
+
+    def lock(self, room_id):
+        """
+        Per-room lock so concurrent handlers don't interleave mutations of the same game.
+        """
+        with self._lock:
+            lock = self.locks.get(room_id)
+            if lock is None:
+                lock = self.locks[room_id] = threading.RLock()
+            return lock
+
+    def __contains__(self, room_id):
+        return room_id in self.games
+
+    def __len__(self):
+        return len(self.games)
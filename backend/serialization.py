@@ -0,0 +1,285 @@
+from game_logic import *
+from order_book import book_from_dict
+from records import ACTION_CODES
+from datetime import datetime
+
+
+# Serialized form of each persisted Player field, keyed by attribute name
+PLAYER_FIELDS = {
+    "username": lambda player: player.get_name(),
+    "status": lambda player: player.get_status(),
+    "last_active": lambda player: player.get_last_active(),
+    "high_low": lambda player: player.high_low,
+    "contract": lambda player: {
+        "type_of_action": player.contract.type_of_action if player.contract else None,
+        "number": player.contract.number if player.contract else None,
+    },
+    "buy_count": lambda player: player.buy_count,
+    "sell_count": lambda player: player.sell_count,
+    "record": lambda player: record_list(player),
+    "cumulative_pnl": lambda player: player.cumulative_pnl,
+    "round_pnl": lambda player: player.round_pnl,
+}
+
+# Serialized form of each persisted top-level Game field, keyed by attribute name
+GAME_FIELDS = {
+    "host": lambda game: game.get_host(),
+    "player_count": lambda game: game.player_count,
+    "current_round": lambda game: game.current_round,
+    "timer": lambda game: game.timer,
+    "dices": lambda game: [dice.get_value() for dice in game.dices] if game.dices else None,
+    "coin": lambda game: game.coin.get_value() if game.coin else None,
+    "book": lambda game: game.book.to_dict(),
+    "current_bid": lambda game: game.current_bid,
+    "current_ask": lambda game: game.current_ask,
+    "bid_player": lambda game: game.bid_player.get_name() if game.bid_player else None,
+    "ask_player": lambda game: game.ask_player.get_name() if game.ask_player else None,
+    "hit_player": lambda game: game.hit_player.get_name() if game.hit_player else None,
+    "lift_player": lambda game: game.lift_player.get_name() if game.lift_player else None,
+    "market_active": lambda game: game.market_active,
+    "round_active": lambda game: game.round_active,
+    "fair_value": lambda game: game.fair_value,
+}
+
+
+def record_list(player):
+    record = player._record
+    # A record still in its stored form is copied as it is, see Player.load_record
+    return list(record) if record.__class__ is list else record.to_list()
+
+
+# Top-level fields that Dice.roll and Coin.flip change in place, out of sight of change tracking
+UNTRACKED_GAME_FIELDS = ("dices", "coin")
+
+DICE_ROLL = ACTION_CODES["dice_roll"]
+
+
+def serialize_player(player, record=True):
+    """
+    Memoized on the player: only fields changed since the previous call are
+    rebuilt and record entries appended since then are added to the cached
+    list. Returns a new dict (and record list) every time, so callers may
+    keep or change it.
+    """
+    cached = player._serialized
+    stale = player.take_stale()
+    if cached is None:
+        cached = player._serialized = {key: field(player) for key, field in PLAYER_FIELDS.items()}
+    else:
+        for name in stale:
+            if name in PLAYER_FIELDS:
+                cached[name] = PLAYER_FIELDS[name](player)
+        entries = cached["record"]
+        length = player.record_length()
+        if len(entries) < length:
+            entries.extend(player.record[len(entries):])
+        elif len(entries) > length:
+            cached["record"] = record_list(player)
+
+    player_data = dict(cached)
+    if record:
+        player_data["record"] = list(cached["record"])
+    else:
+        del player_data["record"]
+    return player_data
+
+
+def serialize_game(game, records=True):
+    """
+    Memoized like serialize_player: top-level fields are only rebuilt when
+    they changed, players through their own caches.
+    """
+    cached = game._serialized
+    stale = game.take_stale()
+    if cached is None:
+        cached = game._serialized = {key: field(game) for key, field in GAME_FIELDS.items()}
+    else:
+        for name in stale.union(UNTRACKED_GAME_FIELDS):
+            if name in GAME_FIELDS:
+                cached[name] = GAME_FIELDS[name](game)
+
+    game_data = {"players": [serialize_player(player, records) for player in game.players]}
+    game_data.update(cached)
+    return game_data
+
+
+def dice_roll(player):
+    record = player._record
+    if record.__class__ is list:
+        return next((price for action, price in record if action == "dice_roll"), None)
+    try:
+        return record.prices[record.codes.index(DICE_ROLL)]
+    except ValueError:
+        return None
+
+
+def serialize_view(game):
+    """
+    What a client needs to render a room: serialize_game without the order
+    book and the players' trade records, so its size doesn't grow with the
+    number of trades. The one record entry clients read, the dice roll, is
+    kept as dice_roll.
+    """
+    game_data = serialize_game(game, records=False)
+    del game_data["book"]
+    for player, player_data in zip(game.players, game_data["players"]):
+        player_data["dice_roll"] = dice_roll(player)
+    return game_data
+
+
+# Player fields of a view only the player they belong to gets to see
+PRIVATE_FIELDS = ("high_low", "contract", "dice_roll")
+
+
+def serialize_views(game):
+    """
+    serialize_view split into the public view the whole room gets and, per
+    username, the private overlay of that player's own PRIVATE_FIELDS.
+    """
+    view = serialize_view(game)
+    private = {}
+    for player_data in view["players"]:
+        private[player_data["username"]] = {field: player_data.pop(field) for field in PRIVATE_FIELDS}
+    return view, private
+
+
+def strip_private(game_data):
+    """
+    A serialize_game result without any player's PRIVATE_FIELDS, for the
+    sockets of a whole room: the dice roll is dropped from the records too.
+    """
+    players = []
+    for player_data in game_data["players"]:
+        player_data = {key: value for key, value in player_data.items() if key not in PRIVATE_FIELDS}
+        if "record" in player_data:
+            player_data["record"] = [entry for entry in player_data["record"] if entry[0] != "dice_roll"]
+        players.append(player_data)
+    return dict(game_data, players=players)
+
+
+def build_update(game, prefix="game"):
+    """
+    Builds a MongoDB update document holding only what changed since the game
+    was last marked clean: $set for changed fields, $inc for counters and
+    $push for trades appended to a player's record. Falls back to one $set of
+    the whole game if it was never persisted. Returns None if nothing changed.
+    """
+    if not game.persisted:
+        return {"$set": {prefix: serialize_game(game)}}
+
+    set_fields = {}
+    inc_fields = {}
+    push_fields = {}
+
+    for name in game._dirty:
+        if name == "players":
+            set_fields[f"{prefix}.players"] = [serialize_player(player) for player in game.players]
+        else:
+            set_fields[f"{prefix}.{name}"] = GAME_FIELDS[name](game)
+    for name, amount in game._increments.items():
+        if amount:
+            inc_fields[f"{prefix}.{name}"] = amount
+
+    # Positional player paths are only valid while the players list itself is unchanged
+    if "players" not in game._dirty:
+        for index, player in enumerate(game.players):
+            player_prefix = f"{prefix}.players.{index}"
+            for name in player._dirty:
+                set_fields[f"{player_prefix}.{name}"] = PLAYER_FIELDS[name](player)
+            for name, amount in player._increments.items():
+                if amount:
+                    inc_fields[f"{player_prefix}.{name}"] = amount
+            if "record" not in player._dirty and player.record_length() > player.record_flushed:
+                push_fields[f"{player_prefix}.record"] = {"$each": player.record[player.record_flushed:]}
+
+    update = {}
+    if set_fields:
+        update["$set"] = set_fields
+    if inc_fields:
+        update["$inc"] = inc_fields
+    if push_fields:
+        update["$push"] = push_fields
+    return update or None
+
+
+def deserialize_game(game_data):
+    game = Game()
+
+    # Restore players
+    for player_data in game_data.get("players", []):
+        player = Player(
+            name=player_data.get("username", "Unknown"),
+            status=player_data.get("status", "active"),
+            last_active=(
+                datetime.fromisoformat(player_data["last_active"])
+                if player_data.get("last_active")
+                else None
+            ),
+        )
+        player.status = player_data.get("status")
+        player.high_low = player_data.get("high_low")
+        player.buy_count = player_data.get("buy_count", 0)
+        player.sell_count = player_data.get("sell_count", 0)
+        player.load_record(player_data.get("record", []))
+        player.cumulative_pnl = player_data.get("cumulative_pnl", 0)
+        player.round_pnl = player_data.get("round_pnl", 0)
+
+        # Restore contract
+        contract_data = player_data.get("contract")
+        if contract_data and contract_data["type_of_action"]:
+            player.contract = Action(
+                type_of_action=contract_data["type_of_action"],
+                number=contract_data["number"],
+            )
+
+        game.player_join(player)
+
+    # Restore game state
+    game.set_host(game_data.get("host", None))
+    game.player_count = game_data.get("player_count", 0)
+    game.current_round = game_data.get("current_round", 0)
+    game.timer = game_data.get("timer", 0)
+    game.dices = (
+        [Dice() for _ in range(len(game_data["dices"]))] if game_data.get("dices") else None
+    )
+    if game.dices and game_data.get("dices"):
+        for dice, value in zip(game.dices, game_data["dices"]):
+            dice.value = value
+
+    game.coin = Coin()
+    if game_data.get("coin"):
+        game.coin.value = game_data["coin"]
+
+    game.current_bid = game_data.get("current_bid", 0)
+    game.current_ask = game_data.get("current_ask", 21)
+    game.market_active = game_data.get("market_active", True)
+    game.round_active = game_data.get("round_active", False)
+    game.fair_value = game_data.get("fair_value", 0)
+
+    # Restore player references
+    bid_player_name = game_data.get("bid_player")
+    ask_player_name = game_data.get("ask_player")
+    hit_player_name = game_data.get("hit_player")
+    lift_player_name = game_data.get("lift_player")
+
+    if bid_player_name:
+        game.bid_player = game.find_player(bid_player_name)
+    if ask_player_name:
+        game.ask_player = game.find_player(ask_player_name)
+    if hit_player_name:
+        game.hit_player = game.find_player(hit_player_name)
+    if lift_player_name:
+        game.lift_player = game.find_player(lift_player_name)
+
+    # Rooms saved before the order book existed only have the top quotes
+    if "book" in game_data:
+        game.book = book_from_dict(game_data["book"])
+    else:
+        if game.bid_player and game.current_bid:
+            game.book.place(game.bid_player.name, "bid", game.current_bid)
+        if game.ask_player and game.current_ask < 21:
+            game.book.place(game.ask_player.name, "ask", game.current_ask)
+
+    # The restored state is what the database already holds
+    game.mark_clean()
+    return game
@@ -0,0 +1,68 @@
+try:
+    import numpy as np
+except ImportError:  # settlement falls back to Game's per-trade loop
+    np = None
+
+from records import ACTION_CODES
+
+LONG = ACTION_CODES["long"]
+SHORT = ACTION_CODES["short"]
+CONTRACT_PENALTY = 100
+
+
+def available():
+    return np is not None
+
+
+def round_pnls(games):
+    """
+    Settles the current round of every game at once and returns, per game,
+    the round P/L of each player in player order.
+
+    All players' trade records are concatenated into flat code/price arrays so
+    trade P/L against each game's fair_value, the unfulfilled-contract
+    penalties and the per-player sums are a handful of array operations,
+    however many rooms and trades there are. Gives the same numbers as the
+    per-trade loop in Game.settle_player.
+    """
+    players = [player for game in games for player in game.players]
+    if not players:
+        return [[] for _ in games]
+
+    player_counts = [len(game.players) for game in games]
+    player_game = np.repeat(np.arange(len(games)), player_counts)
+    fair_values = np.array([game.fair_value for game in games], dtype=np.int64)
+
+    # Trade P/L, one entry per record line; dice rolls and quotes count as 0
+    lengths = np.fromiter((len(player.record) for player in players), dtype=np.int64, count=len(players))
+    trade_pnl = np.zeros(len(players), dtype=np.int64)
+    if lengths.sum():
+        codes = np.concatenate([np.frombuffer(player.record.codes, dtype=np.int8) for player in players])
+        prices = np.concatenate([
+            np.frombuffer(player.record.prices, dtype=np.dtype(f"i{player.record.prices.itemsize}"))
+            for player in players
+        ]).astype(np.int64)
+        owner = np.repeat(np.arange(len(players)), lengths)
+        fair = fair_values[player_game[owner]]
+        pnl = np.where(codes == LONG, fair - prices, 0) + np.where(codes == SHORT, prices - fair, 0)
+        np.add.at(trade_pnl, owner, pnl)
+
+    # Contract penalties
+    contract_types = [player.contract.type_of_action if player.contract else None for player in players]
+    is_long = np.array([action == "long" for action in contract_types])
+    is_short = np.array([action == "short" for action in contract_types])
+    required = np.array([player.contract.number if player.contract and player.contract.number is not None else 0
+                         for player in players], dtype=np.int64)
+    buy_counts = np.array([player.buy_count for player in players], dtype=np.int64)
+    sell_counts = np.array([player.sell_count for player in players], dtype=np.int64)
+    missed = (is_long & (buy_counts < required)) | (is_short & (sell_counts < required))
+
+    totals = (trade_pnl - np.where(missed, CONTRACT_PENALTY, 0)).tolist()
+
+    # Split back into one list per game
+    result = []
+    start = 0
+    for count in player_counts:
+        result.append(totals[start:start + count])
+        start += count
+    return result
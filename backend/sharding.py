@@ -0,0 +1,198 @@
+import atexit
+import bisect
+import hashlib
+import os
+import queue
+import socket
+import threading
+
+import socketio
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping room ids to worker ids. Each worker gets
+    many points on the ring, so adding or removing one worker only moves
+    about 1/n of the rooms.
+    """
+
+    def __init__(self, workers, replicas=100):
+        self.workers = list(workers)
+        self.points = []
+        for worker in self.workers:
+            for replica in range(replicas):
+                self.points.append((self._hash(f"{worker}:{replica}"), worker))
+        self.points.sort()
+        self.keys = [point for point, _ in self.points]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def owner(self, key):
+        index = bisect.bisect(self.keys, self._hash(key)) % len(self.points)
+        return self.points[index][1]
+
+
+class Shards:
+    """
+    This worker's view of the deployment: its own id, the ring over all
+    workers and, for forwarding HTTP requests, each worker's base URL.
+    """
+
+    def __init__(self, worker_id, workers=None, urls=None):
+        self.worker_id = worker_id
+        self.ring = HashRing(workers or [worker_id])
+        self.urls = urls or {}
+
+    @classmethod
+    def from_env(cls):
+        """
+        WORKER_ID names this process, WORKERS lists every worker id and
+        WORKER_URLS maps them to base URLs, e.g. "0=http://10.0.0.1:5001,1=...".
+        Without them there is a single worker that owns every room.
+        """
+        worker_id = os.environ.get("WORKER_ID", "0")
+        urls = {}
+        for entry in filter(None, os.environ.get("WORKER_URLS", "").split(",")):
+            name, url = entry.split("=", 1)
+            urls[name.strip()] = url.strip().rstrip("/")
+        workers = [name.strip() for name in os.environ.get("WORKERS", "").split(",") if name.strip()]
+        return cls(worker_id, workers or list(urls) or [worker_id], urls)
+
+    @property
+    def workers(self):
+        return self.ring.workers
+
+    def owner(self, room_id):
+        return self.ring.owner(room_id)
+
+    def is_local(self, room_id):
+        return self.owner(room_id) == self.worker_id
+
+
+class RoomCommands:
+    """
+    Mixin for a python-socketio pub/sub client manager that also carries
+    room commands between workers: a worker that receives a socket event for
+    a room it doesn't own publishes it, and the owner runs its handler.
+    """
+    worker_id = None
+    on_command = None  # on_command(message) runs a forwarded event on the owner
+
+    def send_command(self, worker, event, data, sid):
+        self._publish({"method": "room_command", "worker": worker, "event": event,
+                       "data": data, "sid": sid, "host_id": self.host_id})
+
+    def _listen(self):
+        for message in super()._listen():
+            data = message
+            if not isinstance(data, dict):
+                try:
+                    data = self.json.loads(message)
+                except ValueError:
+                    data = None
+            if isinstance(data, dict) and data.get("method") == "room_command":
+                if data.get("worker") == self.worker_id and self.on_command is not None:
+                    self.server.start_background_task(self.on_command, data)
+                continue
+            yield message
+
+
+class LocalManager(socketio.PubSubManager):
+    """
+    In-process message queue: every manager on the same channel in this
+    process receives every message. Lets tests run several servers side by
+    side without any broker.
+    """
+    name = "local"
+    channels = {}  # channel -> queues of the managers listening on it
+    channels_lock = threading.Lock()
+
+    def __init__(self, url="local://", channel="socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue = queue.Queue()
+        with self.channels_lock:
+            self.channels.setdefault(channel, []).append(self.queue)
+
+    def _publish(self, data):
+        message = self.json.dumps(data)
+        with self.channels_lock:
+            listeners = list(self.channels.get(self.channel, []))
+        for listener in listeners:
+            listener.put(message)
+
+    def _listen(self):
+        while True:
+            yield self.queue.get()
+
+
+class UnixSocketManager(socketio.PubSubManager):
+    """
+    Message queue for several workers on one machine without a broker:
+    each process binds a datagram socket in a shared directory and a
+    publish is sent to every socket found there.
+    """
+    name = "unix"
+    max_message = 1 << 20
+
+    def __init__(self, url="unix:///tmp/socketio", channel="socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.directory = os.path.join(url[len("unix://"):] or "/tmp/socketio", channel)
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{self.host_id}.sock")
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.listener.bind(self.path)
+        # Non-blocking so a worker that stopped reading can't stall the publisher
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+        self.sender_lock = threading.Lock()
+        atexit.register(self._unlink)
+
+    def _unlink(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _publish(self, data):
+        message = self.json.dumps(data).encode()
+        with self.sender_lock:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                try:
+                    self.sender.sendto(message, path)
+                except ConnectionRefusedError:
+                    # Socket file left behind by a worker that is gone
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                except OSError as e:
+                    print(f"Dropped message queue publish to {name}: {e}")
+
+    def _listen(self):
+        while True:
+            yield self.listener.recv(self.max_message)
+
+
+def client_manager(url, worker_id, write_only=False):
+    """
+    Builds the Socket.IO client manager for a SOCKETIO_MESSAGE_QUEUE URL:
+    redis://, amqp:// (kombu), local:// or unix:///some/dir. Returns None
+    without a URL, i.e. a single process with the default in-memory manager.
+    """
+    if not url:
+        return None
+    if url.startswith("local://"):
+        base = LocalManager
+    elif url.startswith("unix://"):
+        base = UnixSocketManager
+    elif url.startswith(("redis://", "rediss://", "valkey://", "valkeys://")):
+        base = socketio.RedisManager
+    else:
+        base = socketio.KombuManager
+    manager_class = type(f"Sharded{base.__name__}", (RoomCommands, base), {})
+    manager = manager_class(url, write_only=write_only)
+    manager.worker_id = worker_id
+    return manager
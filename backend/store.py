@@ -0,0 +1,326 @@
+import abc
+import copy
+import os
+import threading
+import uuid
+
+from bson.objectid import ObjectId
+import bson
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import lobby
+from models import rooms_collection, ensure_indexes
+
+
+class DuplicateRoom(Exception):
+    """
+    Raised by RoomStore.put when a unique room field is already taken.
+    """
+
+    def __init__(self, field):
+        super().__init__(f"Duplicate room {field}")
+        self.field = field  # "name" or "room_code"
+
+
+def valid_room_id(room_id):
+    # Room ids are ObjectId hex strings, anything else can't name a room
+    return isinstance(room_id, str) and ObjectId.is_valid(room_id)
+
+
+class RoomStore(abc.ABC):
+    """
+    Where room documents live. Handlers, the write-behind stage and the lobby
+    only go through these methods, so the app runs the same against MongoDB
+    or against a plain dict in memory.
+
+    fields is a MongoDB-style top level projection, e.g. {"game": 1} or {"game": 0}.
+    Updates passed to patch use the $set/$inc/$push operators build_update produces.
+
+    Every room has a version that conditional patches check and bump: a patch
+    with version=n only applies while the stored room is still at n, which is
+    how a process notices that someone else wrote the room since it loaded it.
+    Conditional patches also leave the id of the write attempt in the room, so
+    after a failed batch landed tells which of its writes went through anyway.
+    """
+
+    @abc.abstractmethod
+    def get(self, room_id, fields=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_many(self, room_ids, fields=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def find_by_code(self, room_code, fields=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def put(self, room):
+        # Inserts a new room and returns its id as a string, raises DuplicateRoom
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def patch(self, room_id, update, version=None, write=None):
+        # Returns False if version was given and the room is no longer at it; write is
+        # the id of this attempt, a new one if None
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def patch_many(self, updates, write=None):
+        # updates: list of (room_id, update, version or None), written as one batch where
+        # the backend can; write is a unique id of this attempt. Returns (ids of the rooms
+        # whose version didn't match, {room_id: error} of the rooms that failed on their own)
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def landed(self, room_ids, write):
+        # Ids of the rooms that conditional patch write was applied to
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, room_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list_summaries(self, limit=None, cursor=None, public_only=False, has_space=False):
+        # Same contract as lobby.list_rooms: (formatted rooms, next cursor)
+        raise NotImplementedError
+
+    def prepare(self):
+        # Startup work such as index provisioning and migrations
+        pass
+
+
+# Unique room fields and the index that enforces each
+UNIQUE_INDEXES = {"name": "name_unique", "room_code": "room_code_unique"}
+
+
+class MongoRoomStore(RoomStore):
+    def __init__(self, collection):
+        self.collection = collection
+        # Unique fields put has to check itself, until prepare has built their indexes
+        self.unindexed = list(UNIQUE_INDEXES)
+
+    def get(self, room_id, fields=None):
+        return self.collection.find_one({"_id": ObjectId(room_id)}, fields)
+
+    def get_many(self, room_ids, fields=None):
+        return list(self.collection.find({"_id": {"$in": [ObjectId(room_id) for room_id in room_ids]}}, fields))
+
+    def find_by_code(self, room_code, fields=None):
+        return self.collection.find_one({"room_code": room_code}, fields)
+
+    def put(self, room):
+        for field in self.unindexed:
+            if self.collection.count_documents({field: room.get(field)}, limit=1):
+                raise DuplicateRoom(field)
+        try:
+            return str(self.collection.insert_one(room).inserted_id)
+        except DuplicateKeyError as e:
+            room.pop("_id", None)
+            key_pattern = (e.details or {}).get("keyPattern")
+            if key_pattern is None:
+                # Older servers don't say which index it was, ask the name index
+                name_taken = self.collection.count_documents({"name": room.get("name")}, limit=1) > 0
+            else:
+                name_taken = "name" in key_pattern
+            raise DuplicateRoom("name" if name_taken else "room_code")
+
+    def _conditional(self, room_id, update, version, write):
+        query = {"_id": ObjectId(room_id)}
+        if version is None:
+            return query, update
+        # Rooms stored before versions existed count as version 0
+        query["version"] = version if version else {"$in": [0, None]}
+        update = dict(update)
+        update["$inc"] = dict(update.get("$inc", {}), version=1)
+        # The write id tells our writes from another process bumping the same version
+        # (a bulk write only reports how many filters matched, not which)
+        update["$push"] = dict(update.get("$push", {}), writes={"$each": [write], "$slice": -16})
+        return query, update
+
+    def patch(self, room_id, update, version=None, write=None):
+        query, update = self._conditional(room_id, update, version, write or uuid.uuid4().hex)
+        return self.collection.update_one(query, update).matched_count > 0 or version is None
+
+    def patch_many(self, updates, write=None):
+        write = write or uuid.uuid4().hex
+        failed = {}
+        operations = []
+        written = []  # (room_id, version) of each operation
+        for room_id, update, version in updates:
+            query, update = self._conditional(room_id, update, version, write)
+            try:
+                # A room BSON can't encode fails on its own instead of failing the whole batch
+                bson.encode(update)
+            except Exception as e:
+                failed[room_id] = e
+                continue
+            operations.append(UpdateOne(query, update))
+            written.append((room_id, version))
+        if not operations:
+            return [], failed
+
+        try:
+            matched = self.collection.bulk_write(operations, ordered=False).matched_count
+        except BulkWriteError as e:
+            # Unordered, so every operation without an error of its own was applied
+            for error in e.details.get("writeErrors", []):
+                failed[written[error["index"]][0]] = error.get("errmsg")
+            matched = e.details.get("nMatched", 0)
+        if matched + len(failed) == len(updates):
+            return [], failed
+
+        # Some filters didn't match: rooms whose recent writes don't include this one lost a race,
+        # deleted rooms are nobody's conflict
+        conditional = [ObjectId(room_id) for room_id, version in written if version is not None and room_id not in failed]
+        stored = self.collection.find({"_id": {"$in": conditional}}, {"writes": 1})
+        return [str(room["_id"]) for room in stored if write not in room.get("writes", [])], failed
+
+    def landed(self, room_ids, write):
+        stored = self.collection.find({"_id": {"$in": [ObjectId(room_id) for room_id in room_ids]}, "writes": write}, {"_id": 1})
+        return [str(room["_id"]) for room in stored]
+
+    def delete(self, room_id):
+        self.collection.delete_one({"_id": ObjectId(room_id)})
+
+    def list_summaries(self, limit=None, cursor=None, public_only=False, has_space=False):
+        return lobby.list_rooms(self.collection, limit=limit, cursor=cursor, public_only=public_only, has_space=has_space)
+
+    def prepare(self):
+        missing = ensure_indexes(self.collection)
+        self.unindexed = [field for field, index in UNIQUE_INDEXES.items() if index in missing]
+        lobby.backfill_summaries(self.collection)
+
+
+class MemoryRoomStore(RoomStore):
+    """
+    Dict-backed store for load tests and profiling without a database.
+    Documents are copied in and out, so callers can't alias stored state,
+    the same as with a real database.
+    """
+
+    def __init__(self):
+        self.rooms = {}  # ObjectId -> room document, insertion (= creation) order
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _project(room, fields):
+        if room is None:
+            return None
+        if not fields:
+            return copy.deepcopy(room)
+        if any(fields.values()):
+            keys = [key for key, include in fields.items() if include] + ["_id"]
+            return copy.deepcopy({key: room[key] for key in keys if key in room})
+        return copy.deepcopy({key: value for key, value in room.items() if key not in fields})
+
+    def get(self, room_id, fields=None):
+        with self._lock:
+            return self._project(self.rooms.get(ObjectId(room_id)), fields)
+
+    def get_many(self, room_ids, fields=None):
+        with self._lock:
+            rooms = [self.rooms.get(ObjectId(room_id)) for room_id in room_ids]
+            return [self._project(room, fields) for room in rooms if room is not None]
+
+    def find_by_code(self, room_code, fields=None):
+        with self._lock:
+            for room in self.rooms.values():
+                if room.get("room_code") == room_code:
+                    return self._project(room, fields)
+        return None
+
+    def put(self, room):
+        with self._lock:
+            for field in ("name", "room_code"):
+                if any(other.get(field) == room.get(field) for other in self.rooms.values()):
+                    raise DuplicateRoom(field)
+            room_id = room.setdefault("_id", ObjectId())
+            self.rooms[room_id] = copy.deepcopy(room)
+            return str(room_id)
+
+    @staticmethod
+    def _resolve(document, path):
+        # Container and key a dotted path (list indices included) points at
+        parts = path.split(".")
+        target = document
+        for part in parts[:-1]:
+            target = target[int(part)] if isinstance(target, list) else target.setdefault(part, {})
+        key = parts[-1]
+        return target, int(key) if isinstance(target, list) else key
+
+    def _apply(self, room, update):
+        for path, value in update.get("$set", {}).items():
+            target, key = self._resolve(room, path)
+            target[key] = copy.deepcopy(value)
+        for path, amount in update.get("$inc", {}).items():
+            target, key = self._resolve(room, path)
+            if isinstance(target, list):
+                target[key] += amount
+            else:
+                target[key] = target.get(key, 0) + amount
+        for path, value in update.get("$push", {}).items():
+            target, key = self._resolve(room, path)
+            items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+            if isinstance(target, dict):
+                target.setdefault(key, [])
+            target[key].extend(copy.deepcopy(items))
+
+    def patch(self, room_id, update, version=None, write=None):
+        with self._lock:
+            room = self.rooms.get(ObjectId(room_id))
+            if room is None:
+                return version is None
+            if version is not None:
+                if room.get("version", 0) != version:
+                    return False
+            self._apply(room, update)
+            if version is not None:
+                room["version"] = version + 1
+                room["writes"] = room.get("writes", [])[-15:] + [write or uuid.uuid4().hex]
+            return True
+
+    def patch_many(self, updates, write=None):
+        write = write or uuid.uuid4().hex
+        conflicts = []
+        failed = {}
+        for room_id, update, version in updates:
+            try:
+                patched = self.patch(room_id, update, version, write)
+            except Exception as e:
+                failed[room_id] = e
+                continue
+            if not patched and self.get(room_id, {"_id": 1}) is not None:
+                conflicts.append(room_id)
+        return conflicts, failed
+
+    def landed(self, room_ids, write):
+        with self._lock:
+            rooms = [self.rooms.get(ObjectId(room_id)) for room_id in room_ids]
+            return [str(room["_id"]) for room in rooms if room is not None and write in room.get("writes", [])]
+
+    def delete(self, room_id):
+        with self._lock:
+            self.rooms.pop(ObjectId(room_id), None)
+
+    def list_summaries(self, limit=None, cursor=None, public_only=False, has_space=False):
+        with self._lock:
+            rooms = [lobby.format_room(room) for room in self.rooms.values()]
+        return lobby.filter_rooms(rooms, limit=limit, cursor=cursor, public_only=public_only, has_space=has_space)
+
+
+STORES = {
+    "mongo": lambda: MongoRoomStore(rooms_collection),
+    "memory": MemoryRoomStore,
+}
+
+
+def new_store(kind=None):
+    """
+    ROOM_STORE=memory runs the app without any database, rooms only live as
+    long as the process.
+    """
+    return STORES[kind or os.environ.get("ROOM_STORE", "mongo")]()
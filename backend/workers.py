@@ -0,0 +1,44 @@
+"""
+Runs several app.py workers on one machine, each owning a share of the rooms:
+
+    python workers.py 4
+
+Worker i listens on BASE_PORT + i (default 5001 and up) and the workers talk
+through a unix socket message queue, so no broker is needed. Put a load
+balancer with sticky sessions in front of the ports.
+"""
+
+import os
+import subprocess
+import sys
+
+
+def main(count):
+    base_port = int(os.environ.get("BASE_PORT", 5001))
+    host = os.environ.get("WORKER_HOST", "127.0.0.1")
+    workers = [str(i) for i in range(count)]
+    urls = ",".join(f"{worker}=http://{host}:{base_port + i}" for i, worker in enumerate(workers))
+
+    processes = []
+    for i, worker in enumerate(workers):
+        env = dict(os.environ)
+        env.update({
+            "WORKER_ID": worker,
+            "WORKERS": ",".join(workers),
+            "WORKER_URLS": urls,
+            "PORT": str(base_port + i),
+        })
+        env.setdefault("SOCKETIO_MESSAGE_QUEUE", "unix:///tmp/hi-lo-workers")
+        print(f"Starting worker {worker} on port {base_port + i}")
+        processes.append(subprocess.Popen([sys.executable, "app.py"], env=env, cwd=os.path.dirname(os.path.abspath(__file__))))
+
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2)
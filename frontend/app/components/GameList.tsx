@@ -1,9 +1,10 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { View, Text, FlatList, TouchableOpacity, Modal, TextInput, Alert } from 'react-native';
 import { gameListStyles } from '../../styles/global';
 import axios from 'axios';
 import { useRouter } from 'expo-router';
 import { Ionicons } from '@expo/vector-icons';
+import { getSocket } from '../../utils/socket';
 
 export default function GameList() {
   const [rooms, setRooms] = useState([]);
@@ -22,17 +23,75 @@ export default function GameList() {
   const [usernameLengthError, setUsernameLengthError] = useState('');
 
   const router = useRouter();
+  // Lobby version received over the socket, null while not subscribed
+  const lobbyVersion = useRef(null);
 
   useEffect(() => {
     fetchRooms();
   }, []);
 
-  // Auto-refresh interval setup
+  // Live lobby: a full snapshot on subscribe, then only the rooms that changed
+  useEffect(() => {
+    const socket = getSocket();
+
+    const subscribe = () => socket.emit('subscribe_lobby');
+    const onDisconnect = () => {
+      lobbyVersion.current = null;
+    };
+    const onSnapshot = (data) => {
+      lobbyVersion.current = data.version;
+      setRooms(data.rooms);
+      const roomCodeMap = {};
+      data.rooms.forEach((room) => {
+        roomCodeMap[room._id] = room.room_code;
+      });
+      setRoomCodes(roomCodeMap);
+      setIsLoading(false);
+    };
+    const onUpdate = (data) => {
+      // Diffs already contained in the snapshot are skipped
+      if (lobbyVersion.current === null || data.version <= lobbyVersion.current) return;
+      lobbyVersion.current = data.version;
+      const changed = {};
+      data.updated.forEach((room) => {
+        changed[room._id] = room;
+      });
+      setRooms((prev) => prev
+        .filter((room) => !data.removed.includes(room._id))
+        .map((room) => changed[room._id] || room)
+        .concat(data.added));
+      setRoomCodes((prev) => {
+        const roomCodeMap = { ...prev };
+        data.removed.forEach((roomId) => delete roomCodeMap[roomId]);
+        data.added.forEach((room) => {
+          roomCodeMap[room._id] = room.room_code;
+        });
+        return roomCodeMap;
+      });
+    };
+
+    socket.on('connect', subscribe);
+    socket.on('disconnect', onDisconnect);
+    socket.on('lobby_snapshot', onSnapshot);
+    socket.on('lobby_update', onUpdate);
+    if (socket.connected) subscribe();
+
+    return () => {
+      socket.emit('unsubscribe_lobby');
+      lobbyVersion.current = null;
+      socket.off('connect', subscribe);
+      socket.off('disconnect', onDisconnect);
+      socket.off('lobby_snapshot', onSnapshot);
+      socket.off('lobby_update', onUpdate);
+    };
+  }, []);
+
+  // Auto-refresh interval setup, only polls while the live lobby is unavailable
   useEffect(() => {
     const interval = setInterval(() => {
       setCountdown((prev) => {
         if (prev <= 1) {
-          fetchRooms();
+          if (lobbyVersion.current === null) fetchRooms();
           return 5; // Reset countdown after refresh
         }
         return prev - 1;
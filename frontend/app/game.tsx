@@ -230,27 +230,14 @@ export default function GamePage() {
       }));
 
       setPlayers(playersData);
+      coinRef.current = finalData.coin;
 
       const currentPlayer = playersData.find((p: any) => p.username === username);
 
-      if (currentPlayer) {
-        if (currentPlayer.contract && currentPlayer.contract.type_of_action) {
-          setPlayerInfo({
-            contract: currentPlayer.contract,
-          });
-          setPlayerRole('contractor');
-        } else {
-          const hasDiceRoll = currentPlayer.record.some((record: any) => record[0] === 'dice_roll');
-          const diceRoll = hasDiceRoll ? currentPlayer.record.find((record: any) => record[0] === 'dice_roll')[1] : undefined;
-          setPlayerInfo({
-            contract: null,
-            diceRoll: diceRoll,
-            coinFlip: currentPlayer.highLow || finalData.coin,
-          });
-          setPlayerRole('insider');
-        }
-      } else {
+      if (!currentPlayer) {
         console.error('Current player not found in players list');
+      } else if (currentPlayer.contract !== undefined) {
+        applyPrivate(currentPlayer);
       }
 
       setLoading(false);
@@ -409,13 +396,13 @@ export default function GamePage() {
           ...prevLog,
           `${data.playerName} has hit the bid! Sold to ${data.bidPlayer} for $${data.price}.`,
         ]);
-        setCurrentBid(0);
+        setCurrentBid(data.currentBid ?? 0);
       } else if (data.action === "lift") {
         setGameLog((prevLog) => [
           ...prevLog,
           `${data.playerName} has lifted the ask! Bought from ${data.askPlayer} for $${data.price}.`,
         ]);
-        setCurrentAsk(21);
+        setCurrentAsk(data.currentAsk ?? 21);
       } else if (data.action === "ask") {
         setCurrentAsk(data.currentAsk);
         setGameLog((prevLog) => [...prevLog, data.logMessage]);
@@ -441,46 +428,69 @@ export default function GamePage() {
   }, []);
 
   const [startRoundPopup, setStartRoundPopup] = useState(false);
+
+  // The player's own role. Protocol 1 games carry every player's, protocol 2 sends it to
+  // each player alone, as a player_view or with a snapshot
+  const coinRef = useRef('');
+  const applyPrivate = (view: any) => {
+    if (view.contract && view.contract.type_of_action) {
+      setPlayerInfo({ contract: view.contract, diceRoll: undefined, coinFlip: undefined });
+      setPlayerRole('contractor');
+    } else {
+      const diceRoll = view.dice_roll ?? (view.record || []).find((record: any) => record[0] === 'dice_roll')?.[1];
+      setPlayerInfo({
+        contract: null,
+        diceRoll: diceRoll,
+        coinFlip: view.highLow || view.high_low || coinRef.current,
+      });
+      setPlayerRole('insider');
+    }
+  };
+
+  // Round state from a serialized game (protocol 1) or a public game view (protocol 2)
+  const applyGame = (parsedData: any) => {
+    setCurrentRound(parsedData.current_round);
+    setHost(parsedData.host);
+    setPlayerCount(parsedData.player_count);
+    setDices(parsedData.dices);
+    setCoin(parsedData.coin);
+    setMarketActive(parsedData.market_active);
+    setRoundActive(parsedData.round_active);
+    setFairValue(parsedData.fair_value);
+    setPlayers(parsedData.players || []);
+    coinRef.current = parsedData.coin;
+
+    const currentPlayer = (parsedData.players || []).find((p: any) => p.username === username);
+    if (!currentPlayer) {
+      console.error('Current player not found in updated players list');
+    } else if (currentPlayer.contract !== undefined) {
+      applyPrivate(currentPlayer);
+    }
+  };
+
+  const applyStartRound = (parsedData: any) => {
+    applyGame(parsedData);
+    setStartRoundPopup(true);
+    const newRoundDuration = 300; // new round duration (e.g., 300 seconds)
+    setEndTime(Date.now() + newRoundDuration * 1000);
+    setTimeLeft(newRoundDuration);
+    setEndRoundPopup(false);
+    setNewRoundPopup(true);
+  };
+
+  const applyEndRound = (parsedData: any) => {
+    parsedData.players.forEach((player: any) => {
+      console.log(player.username, player.round_pnl);
+    });
+    setPlayers(parsedData.players);
+    setEndRoundPopup(true);
+  };
+
   useEffect(() => {
     const socket = getSocket();
     socket.on('start_round', (data: any) => {
       try {
-        const parsedData = JSON.parse(data.gameData);
-        setCurrentRound(parsedData.current_round);
-        setHost(parsedData.host);
-        setPlayerCount(parsedData.player_count);
-        setDices(parsedData.dices);
-        setCoin(parsedData.coin);
-        setMarketActive(parsedData.market_active);
-        setRoundActive(parsedData.round_active);
-        setFairValue(parsedData.fair_value);
-        setPlayers(parsedData.players || []);
-
-        const currentPlayer = (parsedData.players || []).find((p: any) => p.username === username);
-        if (currentPlayer) {
-          if (currentPlayer.contract && currentPlayer.contract.type_of_action) {
-            setPlayerInfo({ contract: currentPlayer.contract, diceRoll: undefined, coinFlip: undefined });
-            setPlayerRole('contractor');
-          } else {
-            const hasDiceRoll = currentPlayer.record.some((record: any) => record[0] === 'dice_roll');
-            const diceRoll = hasDiceRoll ? currentPlayer.record.find((record: any) => record[0] === 'dice_roll')[1] : undefined;
-            setPlayerInfo({
-              contract: null,
-              diceRoll: diceRoll,
-              coinFlip: currentPlayer.highLow || parsedData.coin,
-            });
-            setPlayerRole('insider');
-          }
-        } else {
-          console.error('Current player not found in updated players list');
-        }
-
-        setStartRoundPopup(true);
-        const newRoundDuration = 300; // new round duration (e.g., 300 seconds)
-        setEndTime(Date.now() + newRoundDuration * 1000);
-        setTimeLeft(newRoundDuration);
-        setEndRoundPopup(false);
-        setNewRoundPopup(true);
+        applyStartRound(JSON.parse(data.gameData));
       } catch (error) {
         console.error('Failed to parse start_round data:', error);
       }
@@ -494,12 +504,7 @@ export default function GamePage() {
     const socket = getSocket();
     socket.on('end_round', (data: any) => {
       try {
-        const parsedData = JSON.parse(data.gameData);
-        parsedData.players.forEach((player: any) => {
-          console.log(player.username, player.round_pnl);
-        });
-        setPlayers(parsedData.players);
-        setEndRoundPopup(true);
+        applyEndRound(JSON.parse(data.gameData));
       } catch (error) {
         console.error('Failed to parse end_round data:', error);
       }
@@ -509,6 +514,108 @@ export default function GamePage() {
     };
   }, []);
 
+  // Protocol 2 feed: every message has the room's next sequence number. On a gap (or a new
+  // epoch after a server restart) the view is rebuilt from a snapshot, which says which
+  // sequence number it is current as of
+  const feedSeq = useRef<number | null>(null);
+  const feedEpoch = useRef<string | null>(null);
+  useEffect(() => {
+    const socket = getSocket();
+    const inSequence = (data: any) => {
+      if (feedSeq.current === null) {
+        return false; // snapshot on its way
+      }
+      if (data.epoch === feedEpoch.current && data.seq <= feedSeq.current) {
+        return false; // already part of the snapshot
+      }
+      if (data.epoch !== feedEpoch.current || data.seq !== feedSeq.current + 1) {
+        feedSeq.current = null;
+        socket.emit('market_snapshot', { roomId });
+        return false;
+      }
+      feedSeq.current = data.seq;
+      return true;
+    };
+
+    socket.on('market_snapshot', (data: any) => {
+      feedSeq.current = data.seq;
+      feedEpoch.current = data.epoch;
+      applyGame(data.game);
+      if (data.private) {
+        applyPrivate(data.private);
+      }
+      setCurrentBid(data.top.currentBid ?? 0);
+      setCurrentAsk(data.top.currentAsk ?? 21);
+    });
+    // This player's own part of the feed message with the same seq
+    socket.on('player_view', (data: any) => {
+      if (data.epoch === feedEpoch.current && data.seq === feedSeq.current) {
+        applyPrivate(data.view);
+      }
+    });
+    // Everything that happened in the room since the last batch: the current top of the book,
+    // its trades and log lines and the counters of the players who traded
+    socket.on('market_batch', (data: any) => {
+      if (!inSequence(data)) {
+        return;
+      }
+      setCurrentBid(data.top.currentBid ?? 0);
+      setCurrentAsk(data.top.currentAsk ?? 21);
+      if (data.log.length > 0) {
+        setGameLog((prevLog) => [...prevLog, ...data.log]);
+      }
+      if (Object.keys(data.players).length > 0) {
+        setPlayers((prevPlayers: any) =>
+          prevPlayers.map((player: any) => ({ ...player, ...data.players[player.username] }))
+        );
+      }
+    });
+    socket.on('round_update', (data: any) => {
+      if (!inSequence(data)) {
+        return;
+      }
+      if (data.event === 'start_round') {
+        applyStartRound(data.game);
+      } else if (data.event === 'end_round') {
+        applyEndRound(data.game);
+      } else {
+        applyGame(data.game);
+      }
+    });
+
+    // The game screen missed whatever the feed sent before it mounted
+    socket.emit('market_snapshot', { roomId });
+    return () => {
+      socket.off('market_snapshot');
+      socket.off('player_view');
+      socket.off('market_batch');
+      socket.off('round_update');
+    };
+  }, [roomId, username]);
+
+  // Sent when the server had to rebuild the room from storage, replaces the local view
+  useEffect(() => {
+    const socket = getSocket();
+    socket.on('room_resync', (data: any) => {
+      try {
+        const parsedData = JSON.parse(data.gameData);
+        setCurrentRound(parsedData.current_round);
+        setHost(parsedData.host);
+        setPlayerCount(parsedData.player_count);
+        setMarketActive(parsedData.market_active);
+        setRoundActive(parsedData.round_active);
+        setCurrentBid(parsedData.current_bid ?? 0);
+        setCurrentAsk(parsedData.current_ask ?? 21);
+        setPlayers(parsedData.players || []);
+      } catch (error) {
+        console.error('Failed to parse room_resync data:', error);
+      }
+    });
+    return () => {
+      socket.off('room_resync');
+    };
+  }, []);
+
   useEffect(() => {
     const socket = getSocket();
     const handleExit = () => {
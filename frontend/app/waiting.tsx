@@ -28,7 +28,8 @@ export default function WaitingRoom({ currentPlayers = [], minPlayers = 4 }: Wai
 
     socket.on('connect', () => {
       console.log('Connected to Socket.IO server');
-      socket.emit('join_room', { roomId, username });
+      // Protocol 2: market data arrives batched as market_batch
+      socket.emit('join_room', { roomId, username, protocol: 2 });
     });
 
     socket.on('disconnect', () => {